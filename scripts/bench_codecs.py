@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import tempfile
+import time
+
+import dawg
+from pwmodel import HistPw, NGramPw, helper
+
+phpbb_leak_file = os.path.join(helper.thisdir, 'data', 'phpbb-withcount.txt.gz')
+
+
+def bench(T, codec, dirname, repeat=5):
+    fname = os.path.join(dirname, 'model.dawg.' + codec)
+    s = time.time()
+    helper.save_dawg(T, fname)
+    save_t = time.time() - s
+    load_t = []
+    for _ in range(repeat):
+        s = time.time()
+        helper.load_dawg(fname, dawg.IntCompletionDAWG)
+        load_t.append(time.time() - s)
+    return os.path.getsize(fname), save_t, min(load_t)
+
+
+if __name__ == "__main__":
+    Usage = "\nUsage: \n$ {} [<pwleak_file>]\n" \
+            "\nCompares the size, save and load times of the histogram and " \
+            "4-gram models of the leak\n(default: the bundled phpbb leak) " \
+            "with every available codec.".format(sys.argv[0])
+    if len(sys.argv) > 2:
+        print(Usage)
+        sys.exit(1)
+    leak_file = sys.argv[1] if len(sys.argv) > 1 else phpbb_leak_file
+    models = [HistPw(leak_file), NGramPw(leak_file, n=4)]
+    codecs = [c for c in helper.available_codecs() if c != 'zip']
+    with tempfile.TemporaryDirectory() as d:
+        for m in models:
+            print("\n{}".format(m))
+            print("codec\t size (MB)\t save (s)\t load (s)")
+            for codec in codecs:
+                size, save_t, load_t = bench(m._T, codec, d)
+                print("{}\t {:.2f}\t\t {:.3f}\t\t {:.3f}"
+                      .format(codec, size / 1e6, save_t, load_t))
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from pwmodel import NGramPw, helper, _fast
+
+phpbb_leak_file = os.path.join(helper.thisdir, 'data', 'phpbb-withcount.txt.gz')
+
+
+def bench(score, batches, threads, repeat=3):
+    """Best time of scoring all the @batches with @threads threads"""
+    times = []
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        for _ in range(repeat):
+            s = time.time()
+            list(pool.map(score, batches))
+            times.append(time.time() - s)
+    return min(times)
+
+
+if __name__ == "__main__":
+    Usage = "\nUsage: \n$ {} [<pwleak_file> [<n> [<max_threads>]]]\n" \
+            "\nScores the passwords of the leak (default: the bundled phpbb " \
+            "leak) with the dense n-gram model\n(default n=4) using 1, 2, 4, " \
+            "... threads, and reports the throughput.".format(sys.argv[0])
+    if len(sys.argv) > 4:
+        print(Usage)
+        sys.exit(1)
+    leak_file = sys.argv[1] if len(sys.argv) > 1 and sys.argv[1] else phpbb_leak_file
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    max_threads = int(sys.argv[3]) if len(sys.argv) > 3 else os.cpu_count()
+    m = NGramPw(leak_file, n=n, dense=True)
+    pws = [pw for pw, _ in helper.open_get_line(leak_file, limit=200000)]
+    batches = [pws[i:i + 10000] for i in range(0, len(pws), 10000)]
+    # the kernel alone, on pre-encoded batches
+    encoded = [m._dense._encode_many(b) for b in batches]
+
+    def kernel(e):
+        out = np.empty(len(e[1]))
+        _fast.ngram_logprobs(m._dense.P, m._dense.next, e[0], e[1],
+                             m._dense.start, out)
+
+    print("{} passwords, {} cpus".format(len(pws), os.cpu_count()))
+    print("threads\t prob_many (pws/s)\t kernel (pws/s)")
+    threads, base = 1, None
+    while threads <= max_threads:
+        t1 = bench(m._dense.prob_many, batches, threads)
+        t2 = bench(kernel, encoded, threads)
+        base = base or (t1, t2)
+        print("{}\t {:.0f} ({:.1f}x)\t\t {:.0f} ({:.1f}x)".format(
+            threads, len(pws) / t1, base[0] / t1, len(pws) / t2, base[1] / t2))
+        threads *= 2
@@ -3,6 +3,7 @@
 import sys
 import os
 from pwmodel import HistPw, PcfgPw, NGramPw
+from pwmodel import create_partial, merge_models
 
 # from IPython.core import ultratb
 # sys.excepthook = ultratb.FormattedTB(mode='Verbose',
@@ -10,11 +11,21 @@ from pwmodel import HistPw, PcfgPw, NGramPw
 
 MIN_FREQ = 0.5
 
+
+def modelname(flag, n):
+    return {'-hist': 'histogram', '-pcfg': 'weir-pcfg',
+            '-ngram': 'ngram-{}'.format(n)}.get(flag)
+
+
 if __name__ == "__main__":
-    Usage = "\nUsage: \n$ {} [-hist|-ngram|-pcfg] <pwleak_file.tar.bz2> [<n>]\n" \
+    Usage = "\nUsage: \n$ {0} [-hist|-ngram|-pcfg] <pwleak_file.tar.bz2> [<n>]\n" \
             "\nCreate histogram or ngram or pcfg model of the pwleak file." \
             "\nThe final output is stored in a file printed below.\n" \
-            "\n<n> is the 'n' for ngram model.\n Uses only passwords with length 6 or more" \
+            "\n<n> is the 'n' for ngram model.\n Uses only passwords with length 6 or more\n" \
+            "\n$ {0} -partial [-hist|-ngram|-pcfg] <pwleak_shard> <out.cnt.gz> [<n>]\n" \
+            "\nCount the passwords of one shard of a leak into a partial count file." \
+            "\n\n$ {0} -merge <leakname> <partial.cnt.gz> [<partial.cnt.gz> ...]\n" \
+            "\nMerge partial count files of the same model into the model of <leakname>." \
         .format(sys.argv[0])
     d = {
         'limit': os.environ.get('LIMIT', -1),
@@ -32,6 +43,15 @@ if __name__ == "__main__":
     elif sys.argv[1] == '-pcfg':
         hm = PcfgPw(sys.argv[2])
         print(hm._modelf)
+    elif sys.argv[1] == '-partial' and len(sys.argv) > 4 and \
+            modelname(sys.argv[2], 3):
+        name = modelname(sys.argv[2], sys.argv[5] if len(sys.argv) > 5 else 3)
+        print(create_partial(name, fname=sys.argv[3], outfname=sys.argv[4],
+                             limit=int(d['limit'])))
+        print(sys.argv[4])
+    elif sys.argv[1] == '-merge' and len(sys.argv) > 3:
+        hm = merge_models(sys.argv[3:], leak=sys.argv[2])
+        print(hm._modelf)
     else:
         print(Usage)
         sys.exit(1)
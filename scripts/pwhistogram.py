@@ -8,7 +8,7 @@ if __name__ == "__main__":
             "This will generate the a .trie and .npz file in the @dirname "\
             "folder, that will very useful Password library, see readpw.py file."\
             "n=-1 will read the whole file, so be patient if the file is really "\
-            "large"\
+            "large.  <pwlist> '-' reads the passwords from stdin, one per line."\
             .format(sys.argv[0])
     if len(sys.argv) < 5:
         print(Usage)
@@ -16,6 +16,9 @@ if __name__ == "__main__":
     fname, dirname, limit = sys.argv[1:4]
     pwm = readpw.Passwords(fname, dirname=dirname, limit=int(limit))
     pws = sys.argv[4:]
+    if pws == ['-']:
+        pws = [l.rstrip('\n') for l in sys.stdin]
+    # all the passwords are ranked in one vectorized lookup
     ranks = pwm.guessranks(pws)
     for pw, r in zip(pws, ranks):
         print("{} --> {}".format(pw, r))
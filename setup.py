@@ -72,6 +72,9 @@ setup(
         'python-levenshtein', 'numpy'   # for readpw
         # 'git://github.com/fujimotos/polyleven'
     ],
+    extras_require={
+        'codecs': ['zstandard', 'lz4'],   # .zst and .lz4 leaks and models
+    },
     scripts=['scripts/buildmodel.py', 'scripts/pwhistogram.py']
     # data_files=[('src/pwmodel/data/', ['ngram-0-phpbb.dawg', 'ngram-3-phpbb.dawg', 'ngram-4-phpbb.dawg'])]
 )
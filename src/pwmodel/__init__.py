@@ -1,4 +1,5 @@
 from . import helper
 from .models import NGramPw, PcfgPw, HistPw
 from .models import fast_fuzzysearch
+from .models import create_partial, merge_models
 __version__ = "1.3.2"
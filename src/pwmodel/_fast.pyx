@@ -3,9 +3,11 @@
 # cython: wraparound=False
 # cython: cdivision=True
 # cython: embedsignature=True
+# cython: language_level=3
 # coding: utf-8
 
 from cpython cimport array
+from libc.math cimport log, NAN
 
 cpdef compute_ngrams(unicode word, unsigned int min_n, unsigned int max_n=0):
     """Get the list of all possible ngrams for a given word.
@@ -32,3 +34,116 @@ cpdef compute_ngrams(unicode word, unsigned int min_n, unsigned int max_n=0):
         for i in range(0, len(extended_word) - ngram_length + 1):
             ngrams.append(extended_word[i:i + ngram_length])
     return ngrams
+
+
+def ngram_logprobs(const double[:, ::1] P, const int[:, ::1] nxt,
+                   const int[:, ::1] ids, const Py_ssize_t[::1] lens,
+                   int start, double[::1] out):
+    """Log probabilities of a batch of passwords under the dense n-gram
+    tables of ngramtable.NGramTable.  Runs without the GIL.
+    Parameters
+    ----------
+    P, nxt : 2-d arrays
+        P[h, c] and NEXT[h, c] of the tables.
+    ids : 2-d int32 array
+        The character ids of a password (followed by END) in every row;
+        -1 for a character that is not in the tables.
+    lens : 1-d intp array
+        Number of ids of every row.
+    start : int
+        The context id of START.
+    out : 1-d float64 array
+        Receives log P[password], or nan if it has a -1 id.
+    """
+    cdef Py_ssize_t i, j
+    cdef int h, c
+    cdef double lp
+    with nogil:
+        for i in range(ids.shape[0]):
+            h, lp = start, 0.0
+            for j in range(lens[i]):
+                c = ids[i, j]
+                if c < 0:
+                    lp = NAN
+                    break
+                lp += log(P[h, c])
+                h = nxt[h, c]
+            out[i] = lp
+
+
+cdef inline int _charclass(Py_UCS4 c) except -1:
+    """The class of @c in helper.regex: 0 for [A-Za-z_], 1 for [0-9], 2 for
+    \\W."""
+    if ('a' <= c <= 'z') or ('A' <= c <= 'Z') or c == '_':
+        return 0
+    if '0' <= c <= '9':
+        return 1
+    if c < 128 or not c.isalnum():
+        return 2
+    raise ValueError("Cannot tokenize the character {!r}".format(c))
+
+
+cpdef list tokenize(unicode word):
+    """Splits @word into the maximal runs of [A-Za-z_], [0-9] and \\W
+    characters, same as helper.tokens, in a single pass."""
+    cdef list toks = []
+    cdef Py_ssize_t i, start = 0, n = len(word)
+    cdef int cls, prev = -1
+    for i in range(n):
+        cls = _charclass(word[i])
+        if cls != prev and i > 0:
+            toks.append(word[start:i])
+            start = i
+        prev = cls
+    if n > 0:
+        toks.append(word[start:])
+    return toks
+
+
+# the signature ('L8') and the nonterminal ('__L8__') of the runs that are
+# shorter than _MAXRUN, by class (L, D, Y) and length
+cdef Py_ssize_t _MAXRUN = 64
+cdef list _SIG = [[x + str(l) for l in range(_MAXRUN)] for x in 'LDY']
+cdef list _NONT = [['__' + x + str(l) + '__' for l in range(_MAXRUN)]
+                   for x in 'LDY']
+
+
+cpdef list pcfg_tokens(unicode word):
+    """The base structure, nonterminals and terminals of @word, same as
+    models.pcfgtokensofw, e.g.,
+    'password@123' -> ['__S__L8Y1D3__', '__L8__', '__Y1__', '__D3__',
+                       'password', '@', '123']
+    A nonterminal is 'L' for a run of letters (without '_'), 'D' for a run
+    of digits, and 'Y' for the rest (as helper.whatchar on the run).
+    """
+    cdef list toks = [], syms = [], sig = []
+    cdef Py_ssize_t i, l, start = 0, n = len(word)
+    cdef int cls, prev = -1, x
+    cdef bint underscore = False
+    cdef Py_UCS4 c = 0
+    for i in range(n + 1):
+        if i < n:
+            c = word[i]
+            cls = _charclass(c)
+        else:
+            cls = -1
+        if i > 0 and cls != prev:
+            x, l = (2 if underscore and prev == 0 else prev), i - start
+            toks.append(word[start:i])
+            if l < _MAXRUN:
+                sig.append(_SIG[x][l])
+                syms.append(_NONT[x][l])
+            else:
+                t = 'LDY'[x] + str(l)
+                sig.append(t)
+                syms.append('__' + t + '__')
+            start, underscore = i, False
+        if c == '_':
+            underscore = True
+        prev = cls
+    return ['__S__' + ''.join(sig) + '__'] + syms + toks
+
+
+def pcfg_tokens_many(list words):
+    """pcfg_tokens of every word in @words"""
+    return [pcfg_tokens(w) for w in words]
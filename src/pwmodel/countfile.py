@@ -0,0 +1,173 @@
+"""Sorted (key, count) files.
+
+A count file is a gzip stream that starts with a small JSON header followed by
+(key, count) records sorted by key.  They are used to spill the count table
+of create_model to disk when it grows too large, and are merged back in a
+single streaming pass, so the final DAWG can be built with bounded memory.
+"""
+
+import gzip
+import heapq
+import itertools
+import json
+import os
+import shutil
+import struct
+import tempfile
+from collections import defaultdict
+
+MAGIC = b'PWCF\x01'
+_REC = struct.Struct('<IQ')   # length of the key in bytes, count
+_HLEN = struct.Struct('<I')
+# Maximum number of count files that are merged at once.
+MAX_FAN_IN = 64
+
+
+def write_counts(fname, items, header=None, compresslevel=6):
+    """Writes the (key, count) pairs in @items to @fname. @items must be
+    sorted by key, and the keys must be unique.
+    @header: a json serializable dict stored in front of the records.
+    Returns the number of records written.
+    """
+    hdr = json.dumps(header or {}).encode('utf-8')
+    n = 0
+    with gzip.open(fname, 'wb', compresslevel=compresslevel) as f:
+        f.write(MAGIC + _HLEN.pack(len(hdr)) + hdr)
+        pack = _REC.pack
+        for k, c in items:
+            k = k.encode('utf-8')
+            f.write(pack(len(k), c) + k)
+            n += 1
+    return n
+
+
+def _read_header(f, fname):
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError("{!r} is not a count file".format(fname))
+    hlen, = _HLEN.unpack(f.read(_HLEN.size))
+    return json.loads(f.read(hlen).decode('utf-8'))
+
+
+def read_header(fname):
+    """Returns the header of the count file @fname"""
+    with gzip.open(fname, 'rb') as f:
+        return _read_header(f, fname)
+
+
+def iter_counts(fname):
+    """Iterates over the (key, count) records of the count file @fname, in
+    sorted order of the keys.
+    """
+    with gzip.open(fname, 'rb') as f:
+        _read_header(f, fname)
+        read, unpack, size = f.read, _REC.unpack, _REC.size
+        while True:
+            rec = read(size)
+            if not rec:
+                break
+            klen, c = unpack(rec)
+            yield read(klen).decode('utf-8'), c
+
+
+def last(counts):
+    """The last of @counts, to merge runs where later counts replace the
+    earlier ones"""
+    c = None
+    for c in counts:
+        pass
+    return c
+
+
+def merge_counts(iterables, combine=sum):
+    """Merges sorted (key, count) iterables into one sorted iterator, adding
+    the counts of the keys that appear in more than one of them.
+    @combine: the function that reduces the counts of a key, which are given
+    in the order of @iterables, into one (e.g., last).
+    """
+    merged = heapq.merge(*iterables, key=lambda kv: kv[0])
+    for k, g in itertools.groupby(merged, key=lambda kv: kv[0]):
+        yield k, combine(c for _, c in g)
+
+
+def merge_count_files(fnames, tmpdir=None, fan_in=MAX_FAN_IN, combine=sum):
+    """Merges the count files @fnames, and returns an iterator of the summed
+    (key, count) pairs in sorted order.  At most @fan_in files are open at
+    any time; if there are more, they are first merged in groups (of
+    consecutive files, so the order seen by @combine is kept) into
+    intermediate files under @tmpdir.
+    """
+    fnames = list(fnames)
+    if len(fnames) > fan_in:
+        tmpdir = tempfile.mkdtemp(prefix='pwcf-', dir=tmpdir)
+        try:
+            level = 0
+            while len(fnames) > fan_in:
+                merged = []
+                for i in range(0, len(fnames), fan_in):
+                    outf = os.path.join(tmpdir, 'merge-{}-{}.cnt.gz'
+                                        .format(level, len(merged)))
+                    write_counts(outf, merge_counts(
+                        (iter_counts(f) for f in fnames[i:i + fan_in]),
+                        combine=combine
+                    ), compresslevel=1)
+                    merged.append(outf)
+                fnames, level = merged, level + 1
+            yield from merge_counts((iter_counts(f) for f in fnames),
+                                    combine=combine)
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+    else:
+        yield from merge_counts((iter_counts(f) for f in fnames),
+                                combine=combine)
+
+
+class SpillCounter(defaultdict):
+    """A defaultdict(int) that writes itself to a sorted run on disk, and
+    clears, once it holds @max_size keys or more.  Call maybe_spill()
+    periodically while counting, and sorted_items() to read the merged
+    counts back.
+    @max_size: maximum number of keys to hold in memory, <= 0 means never
+               spill.
+    @dirname: directory for the runs, defaults to the system temp dir.
+    """
+
+    def __init__(self, max_size=-1, dirname=None):
+        super(SpillCounter, self).__init__(int)
+        self.max_size = max_size
+        self._dirname = dirname
+        self._tmpdir = None
+        self._runs = []
+
+    def maybe_spill(self):
+        if self.max_size > 0 and len(self) >= self.max_size:
+            self.spill()
+
+    def spill(self):
+        if not self:
+            return
+        if self._tmpdir is None:
+            self._tmpdir = tempfile.mkdtemp(prefix='pwcf-', dir=self._dirname)
+        fname = os.path.join(self._tmpdir, 'run-{}.cnt.gz'.format(len(self._runs)))
+        print("Spilling {} keys to {}".format(len(self), fname))
+        write_counts(fname, sorted(self.items()), compresslevel=1)
+        self._runs.append(fname)
+        self.clear()
+
+    def spilled(self):
+        return len(self._runs) > 0
+
+    def sorted_items(self, combine=sum):
+        """Iterates over all the counts, spilled or not, in sorted order of
+        the keys.  The counts of a key in different runs are reduced with
+        @combine (see merge_counts)."""
+        if not self._runs:
+            return iter(sorted(self.items()))
+        self.spill()
+        return merge_count_files(self._runs, tmpdir=self._tmpdir,
+                                 combine=combine)
+
+    def close(self):
+        """Removes the spilled runs"""
+        if self._tmpdir is not None:
+            shutil.rmtree(self._tmpdir, ignore_errors=True)
+            self._tmpdir, self._runs = None, []
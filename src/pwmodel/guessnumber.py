@@ -0,0 +1,51 @@
+"""Monte Carlo estimates of guess numbers.
+
+The guess number of a password under a model is its position in the list of
+all the passwords in decreasing order of their probability.  Following
+Dell'Amico and Filippone ("Monte Carlo Strength Evaluation", CCS 2015), it
+is estimated from a sample x_1..x_N drawn with the sampler of the model
+(with probabilities q) as
+    1 + sum_{i: p(x_i) > p(pw)} 1 / (N q(x_i)),
+which is an unbiased estimate of the number of passwords more probable than
+pw.  The probabilities p(x_i) are stored sorted, together with the running
+sums, so an estimate is a binary search.
+"""
+
+import numpy as np
+
+
+class GuessNumberEstimator(object):
+    """@probs: model probabilities of the sample in decreasing order.
+    @ranks: ranks[i] = sum_{j <= i} 1 / (N q(x_j)).
+    """
+
+    def __init__(self, probs, ranks):
+        self.probs = probs
+        self.ranks = ranks
+        # ascending, for searchsorted
+        self._negprobs = -probs
+
+    @classmethod
+    def build(cls, model, n, seed=None):
+        """Draws @n passwords with model.sample_pws"""
+        pws, q = model.sample_pws(n, seed=seed, return_probs=True)
+        p = model.prob_many(pws)
+        order = np.argsort(-p, kind='stable')
+        return cls(p[order], np.cumsum(1.0 / (n * q[order])))
+
+    def arrays(self):
+        """The arrays saved by models.save_npz, see load"""
+        return dict(probs=self.probs, ranks=self.ranks)
+
+    @classmethod
+    def load(cls, fname):
+        with np.load(fname) as d:
+            return cls(d['probs'], d['ranks'])
+
+    def guess_numbers(self, probs):
+        """Estimated guess numbers of the passwords with probabilities
+        @probs (a numpy array)"""
+        # number of samples that are strictly more probable
+        k = np.searchsorted(self._negprobs, -np.asarray(probs, dtype=float),
+                            side='left')
+        return 1 + np.where(k > 0, self.ranks[np.maximum(k - 1, 0)], 0.0)
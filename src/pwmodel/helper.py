@@ -12,10 +12,27 @@ import struct
 import sys
 from functools import reduce
 import bz2
+import collections
 import gzip
 import functools
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from math import sqrt
+import io
+import lzma
+import zipfile
 import dawg
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame as lz4frame
+except ImportError:
+    lz4frame = None
 
 BASE_DIR = os.getcwd()
 sys.path.append(BASE_DIR)
@@ -224,19 +241,48 @@ def MILLION(n):
     return int(n * 1e6)
 
 
+def _open_zip(filename, mode='rb', errors=None):
+    """Opens the first file in the zip archive @filename (read only)"""
+    if not mode.startswith('r'):
+        raise ValueError("Cannot write zip files: {!r}".format(filename))
+    with zipfile.ZipFile(filename) as z:
+        name = next(i.filename for i in z.infolist() if not i.is_dir())
+        f = z.open(name)
+    if 't' in mode:
+        f = io.TextIOWrapper(f, encoding='utf-8', errors=errors)
+    return f
+
+
+# codec -> (magic bytes, opener). The file extension is the codec name.
+CODECS = collections.OrderedDict([
+    ('gz', (b"\x1f\x8b\x08", gzip.open)),
+    ('bz2', (b"\x42\x5a\x68", bz2.open)),
+    ('zip', (b"\x50\x4b\x03\x04", _open_zip)),
+    ('xz', (b"\xfd7zXZ\x00", lzma.open)),
+    ('zst', (b"\x28\xb5\x2f\xfd", zstandard.open if zstandard else None)),
+    ('lz4', (b"\x04\x22\x4d\x18", lz4frame.open if lz4frame else None)),
+])
+
+
+def codec_of(filename):
+    """returns the codec of @filename from its extension, or None"""
+    ext = filename.rsplit('.', 1)[-1]
+    return ext if ext in CODECS else None
+
+
+def available_codecs():
+    """returns the codecs whose module is installed"""
+    return [c for c, (_, opener) in CODECS.items() if opener is not None]
+
+
 def file_type(filename, param='rb'):
-    """returns the type of file, e.g., gz, bz2, normal"""
-    magic_dict = {
-        b"\x1f\x8b\x08": "gz",
-        b"\x42\x5a\x68": "bz2",
-        b"\x50\x4b\x03\x04": "zip"
-    }
+    """returns the type of file, e.g., gz, bz2, xz, zip, zst, lz4, normal"""
     if param.startswith('w'):
         return filename.split('.')[-1]
-    max_len = max(len(x) for x in magic_dict)
+    max_len = max(len(magic) for magic, _ in CODECS.values())
     with open(filename, 'rb') as f:
         file_start = f.read(max_len)
-    for magic, filetype in list(magic_dict.items()):
+    for filetype, (magic, _) in CODECS.items():
         if file_start.startswith(magic):
             return filetype
     return "no match"
@@ -245,28 +291,234 @@ def file_type(filename, param='rb'):
 def open_(filename, mode='rb'):
     type_ = file_type(filename, mode)
     errors = 'ignore' if 't' in mode else None
-    if type_ == "bz2":
-        f = bz2.open(filename, mode, errors=errors)
-    elif type_ == "gz":
-        f = gzip.open(filename, mode, errors=errors)
+    if type_ in CODECS:
+        opener = CODECS[type_][1]
+        if opener is None:
+            raise ImportError("Reading or writing {!r} needs the module for "
+                              "{!r} files.".format(filename, type_))
+        f = opener(filename, mode, errors=errors)
     else:
         f = open(filename, mode)
     return f
 
 
+# Start of a bzip2 stream: "BZh" + block size + the magic of the first block.
+BZ2_STREAM_START = re.compile(rb'BZh[1-9]1AY&SY')
+BZ2_WINDOW = 1 << 24
+# Largest compressed piece decompressed in one go by the thread pool; a
+# longer stream is decompressed sequentially, in blocks.
+BZ2_MAX_SEGMENT = 1 << 26
+CHUNK_BYTES = 1 << 22
+
+
+def _bz2_streams(f, window=BZ2_WINDOW, max_segment=BZ2_MAX_SEGMENT):
+    """Splits the compressed bzip2 file object @f at the starts of its
+    streams (files written by pbzip2/lbzip2 have many) and yields
+    (offset, stream) pairs.  Only @window bytes (plus the last, incomplete
+    stream) are held in memory at a time.  If a stream grows longer than
+    @max_segment, it is yielded incomplete and the splitting stops.
+    """
+    tail, pos = b'', f.tell()
+    while True:
+        data = f.read(window)
+        if not data:
+            break
+        buf = tail + data
+        starts = [m.start() for m in BZ2_STREAM_START.finditer(buf, 1)]
+        s = 0
+        for e in starts:
+            yield pos + s, buf[s:e]
+            s = e
+        tail, pos = buf[s:], pos + s
+        if len(tail) > max_segment:
+            yield pos, tail
+            return
+    if tail:
+        yield pos, tail
+
+
+def _is_multistream_bz2(f, window=BZ2_WINDOW):
+    """Whether a second stream starts in the first @window bytes of @f"""
+    head = f.read(window)
+    f.seek(0)
+    return BZ2_STREAM_START.search(head, 1) is not None
+
+
+def _bz2_decompress_parallel(f, workers, block_size, max_segment=BZ2_MAX_SEGMENT):
+    """Decompresses the streams of the bzip2 file object @f with @workers
+    threads (bz2 releases the GIL), and yields the decompressed data in
+    order.  If a split turns out not to be a stream boundary, the piece is
+    glued to the next one.  A piece longer than @max_segment is not held:
+    the rest of the file, from the first piece not yet decompressed, is
+    then decompressed sequentially in blocks of @block_size bytes.
+    """
+    pending = collections.deque()
+    rest = None   # offset of the part of @f left to the sequential path
+
+    def retry(off, seg):
+        """glues the failed piece to the next one"""
+        noff, nseg, nfut = pending.popleft()
+        nfut.cancel()
+        seg += nseg
+        if len(seg) > max_segment:
+            return False
+        pending.appendleft((off, seg, pool.submit(bz2.decompress, seg)))
+        return True
+
+    with ThreadPoolExecutor(workers) as pool:
+        long_off = None   # offset of a stream longer than max_segment
+        for off, seg in _bz2_streams(f, max_segment=max_segment):
+            if len(seg) > max_segment:
+                long_off = off
+                break
+            pending.append((off, seg, pool.submit(bz2.decompress, seg)))
+            if len(pending) < 2 * workers:
+                continue
+            off, seg, fut = pending.popleft()
+            try:
+                yield fut.result()
+            except (OSError, EOFError, ValueError):
+                # Not a real stream boundary: retry with the next piece
+                if not retry(off, seg):
+                    rest = off
+                    break
+        if rest is None:
+            while pending:
+                off, seg, fut = pending.popleft()
+                try:
+                    yield fut.result()
+                except (OSError, EOFError, ValueError):
+                    if not pending and long_off is None:
+                        raise
+                    if not pending or not retry(off, seg):
+                        rest = off
+                        break
+            else:
+                rest = long_off
+        for _, _, fut in pending:
+            fut.cancel()
+    if rest is not None:
+        f.seek(rest)
+        with bz2.open(f, 'rb') as d:
+            yield from _read_blocks(d, block_size)
+
+
+def _read_blocks(f, block_size):
+    while True:
+        block = f.read(block_size)
+        if not block:
+            break
+        yield block
+
+
+def _iter_blocks(filename, block_size, workers):
+    """Yields the decompressed content of @filename in blocks.  Only bzip2
+    files with several streams are decompressed in parallel."""
+    if file_type(filename) == 'bz2' and workers > 1:
+        with open(filename, 'rb') as f:
+            if _is_multistream_bz2(f):
+                yield from _bz2_decompress_parallel(f, workers, block_size)
+                return
+    with open_(filename, 'rb') as f:
+        yield from _read_blocks(f, block_size)
+
+
+class PrefetchReader(object):
+    """A read-only binary file object over the decompressed content of
+    @filename.  Decompression runs in a background thread (and, for
+    multi-stream bzip2 files, in a pool of @workers threads) that keeps up
+    to @depth blocks of @block_size bytes ready in a queue, while the
+    consumer parses the previous blocks.
+    """
+
+    def __init__(self, filename, block_size=CHUNK_BYTES, depth=4, workers=None):
+        self._q = queue.Queue(maxsize=depth)
+        self._stop = threading.Event()
+        self._buf, self._pos, self._eof = b'', 0, False
+        workers = workers or os.cpu_count() or 1
+        self._thread = threading.Thread(
+            target=self._produce, args=(filename, block_size, workers),
+            daemon=True
+        )
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self, filename, block_size, workers):
+        try:
+            for block in _iter_blocks(filename, block_size, workers):
+                if not self._put(block):
+                    return
+            self._put(None)
+        except BaseException as ex:
+            self._put(ex)
+
+    def _next_block(self):
+        block = self._q.get()
+        if isinstance(block, BaseException):
+            self._eof = True
+            raise block
+        if block is None:
+            self._eof = True
+            return b''
+        return block
+
+    def read(self, n=-1):
+        # self._buf[self._pos:] is the data not read yet
+        if n is None or n < 0:
+            parts = [self._buf[self._pos:]]
+            while not self._eof:
+                parts.append(self._next_block())
+            self._buf, self._pos = b'', 0
+            return b''.join(parts)
+        while len(self._buf) - self._pos < n and not self._eof:
+            self._buf = self._buf[self._pos:] + self._next_block()
+            self._pos = 0
+        ret = self._buf[self._pos:self._pos + n]
+        self._pos += len(ret)
+        return ret
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
 def load_dawg(f, t=dawg.IntDAWG):
-    if not f.endswith('.gz'):
-        if not os.path.exists(f):
-            f += '.gz'
+    """Reads the DAWG in the file @f, the codec is found from the magic
+    bytes of the file.  If @f does not exist, @f.gz, @f.xz, etc. are tried.
+    """
+    if not os.path.exists(f):
+        for codec in CODECS:
+            if os.path.exists(f + '.' + codec):
+                f = f + '.' + codec
+                break
     T = t()
-    T.read(open_(f, 'rb'))
+    with open_(f, 'rb') as fin:
+        T.read(fin)
     return T
 
 
 def save_dawg(T, fname):
-    if not fname.endswith('gz'):
+    """Writes the DAWG @T to @fname, compressed with the codec given by the
+    extension of @fname (gz, bz2, xz, zst or lz4).  '.gz' is appended if
+    @fname has no such extension.
+    """
+    if not codec_of(fname):
         fname = fname + '.gz'
-    with gzip.open(fname, 'wb') as f:
+    with open_(fname, 'wb') as f:
         T.write(f)
 
 
@@ -298,7 +550,7 @@ def get_line(file_object, limit=-1, sep=r'\s+', pw_filter=lambda x: True, errors
     for l in file_object:
         if limit > 0 and limit <= i:
             break
-        t = re.split(sep, l.rstrip('\n'), maxsplit=1)
+        t = re.split(sep, l.lstrip().rstrip('\n'), maxsplit=1)
         if len(t) != 2: continue
         c, w = t
         c = int(c)
@@ -314,24 +566,116 @@ def get_line(file_object, limit=-1, sep=r'\s+', pw_filter=lambda x: True, errors
             # warning ("Filter Failed or malformed string: ", w, c)
 
 
+def _line_regex(sep):
+    """Regex matching a "<count><sep><password>" line in a block of lines.
+    @sep must not match across lines, so the default whitespace separator
+    is restricted to whitespace other than newline.
+    """
+    if sep == r'\s+':
+        sep = r'[^\S\n]+'
+    return re.compile(r'^[^\S\n]*([0-9]+)(?:{})(.*)$'.format(sep), re.M)
+
+
+def _parse_block(text, sep, line_re):
+    if sep == r'\s+' or not re.search(sep, '\n'):
+        return line_re.findall(text)
+    # @sep can match a newline, so match the lines one by one
+    return [m.groups() for m in map(line_re.match, text.split('\n')) if m]
+
+
+def get_chunks(file_object, chunk_bytes=CHUNK_BYTES, limit=-1, sep=r'\s+',
+               pw_filter=None, min_len=0, max_len=-1, charset=None,
+               errors='ignore'):
+    """Reads the binary @file_object, which is in "uniq -c" format, in blocks
+    of about @chunk_bytes bytes, and yields (counts, pws) for each block,
+    where counts is a numpy int64 array and pws is the list of passwords.
+    Lines that do not parse, have zero count, or have an empty password are
+    dropped.  Filtering is done on the whole block:
+    @min_len, @max_len: bounds on the password length (max_len < 0 means
+                        no upper bound).
+    @charset: if given, only the characters in it count towards the length.
+    @pw_filter: an additional per password filter function.
+    @limit: the total number of passwords to yield (<= 0 for all).
+    """
+    line_re = _line_regex(sep)
+    invalid_re = None
+    if charset is not None:
+        invalid_re = re.compile('[^{}]'.format(
+            ''.join(re.escape(c) for c in sorted(charset))))
+    n, rest = 0, b''
+    while limit <= 0 or n < limit:
+        block = file_object.read(chunk_bytes)
+        if block:
+            block = rest + block
+            i = block.rfind(b'\n') + 1
+            if i == 0:
+                rest = block
+                continue
+            block, rest = block[:i], block[i:]
+        elif rest:
+            block, rest = rest, b''
+        else:
+            break
+        text = block.decode('utf-8', errors=errors)
+        if '\r' in text:
+            text = text.replace('\r\n', '\n').replace('\r', '\n')
+        if '\x00' in text:
+            text = text.replace('\x00', '\\x00')
+        pairs = _parse_block(text, sep, line_re)
+        if not pairs:
+            continue
+        cnts, pws = zip(*pairs)
+        counts = np.fromiter(map(int, cnts), dtype=np.int64, count=len(cnts))
+        lens = np.fromiter(map(len, pws), dtype=np.int64, count=len(pws))
+        keep = (counts > 0) & (lens > 0)
+        if invalid_re is not None and invalid_re.search(text):
+            lens -= np.fromiter(map(len, map(invalid_re.findall, pws)),
+                                dtype=np.int64, count=len(pws))
+        if min_len > 0:
+            keep &= lens >= min_len
+        if max_len >= 0:
+            keep &= lens <= max_len
+        if pw_filter is not None:
+            keep &= np.fromiter(map(pw_filter, pws), dtype=bool, count=len(pws))
+        idx = np.flatnonzero(keep)
+        if limit > 0:
+            idx = idx[:limit - n]
+        if len(idx) == 0:
+            continue
+        n += len(idx)
+        if len(idx) == len(pws):
+            yield counts, list(pws)
+        else:
+            yield counts[idx], [pws[i] for i in idx]
+
+
+def open_get_chunks(filename, chunk_bytes=CHUNK_BYTES, limit=-1, **kwargs):
+    """Opens the password file named @filename and yields its passwords in
+    chunks of (counts, pws), see get_chunks for the @kwargs.
+    """
+    with PrefetchReader(filename, block_size=chunk_bytes) as f:
+        for counts, pws in get_chunks(f, chunk_bytes, limit, **kwargs):
+            yield counts, pws
+
+
 def open_get_line(filename, limit=-1, **kwargs):
     """Opens the password file named @filename and reads first @limit
-    passwords. @kwargs are passed to get_line for further processing.
-    For example, pw_filter etc.
+    passwords. @kwargs are passed to get_chunks for further processing.
+    For example, pw_filter, min_len, charset etc.
     @fielname: string
     @limit: integer
     """
-    allowed_keys_for_get_line = {'sep', 'pw_filter', 'errors'}
+    allowed_keys_for_get_chunks = {'sep', 'pw_filter', 'errors', 'min_len',
+                                   'max_len', 'charset', 'chunk_bytes'}
     for k in list(kwargs.keys()):
-        if k not in allowed_keys_for_get_line:
+        if k not in allowed_keys_for_get_chunks:
             del kwargs[k]
-    print("After filtering: {}".format(kwargs))
-    with open_(filename, 'rt') as f:
-        for w, c in get_line(f, limit, **kwargs):
+    print("After filtering: {}".format(sorted(kwargs)))
+    for counts, pws in open_get_chunks(filename, limit=limit, **kwargs):
+        for w, c in zip(pws, counts.tolist()):
             yield w, c
 
 
-# TODO - Optimize the tokenization process
 regex = r'([A-Za-z_]+)|([0-9]+)|(\W+)'
 
 
@@ -340,13 +684,37 @@ def print_err(*args):
         sys.stderr.write(' '.join([str(a) for a in args]) + '\n')
 
 
-def tokens(w):
-    T = []
-    while w:
-        m = re.match(regex, w)
-        T.append(m.group(0))
-        w = w[len(T[-1]):]
-    return T
+def _charclass(c):
+    """The group of @regex that matches the character @c"""
+    if c == '_' or ('a' <= c <= 'z') or ('A' <= c <= 'Z'):
+        return 0
+    if '0' <= c <= '9':
+        return 1
+    if c < '\x80' or not c.isalnum():
+        return 2
+    raise ValueError("Cannot tokenize the character {!r}".format(c))
+
+
+def _tokens(w):
+    """Splits @w into the runs of characters matched by the groups of @regex
+    (pure python version of _fast.tokenize)"""
+    return [''.join(g) for _, g in itertools.groupby(w, _charclass)]
+
+
+def _pcfg_tokens(w):
+    tok = _tokens(w)
+    sig = ['{0}{1}'.format(whatchar(t), len(t)) for t in tok]
+    return ['__S__' + ''.join(sig) + '__'] + \
+        ['__{}__'.format(s) for s in sig] + tok
+
+
+try:
+    from ._fast import tokenize as tokens, pcfg_tokens, pcfg_tokens_many
+except ImportError:   # an old build of the extension
+    tokens, pcfg_tokens = _tokens, _pcfg_tokens
+
+    def pcfg_tokens_many(words):
+        return [_pcfg_tokens(w) for w in words]
 
 
 def whatchar(c):
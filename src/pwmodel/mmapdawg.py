@@ -0,0 +1,159 @@
+"""A memory mapped, uncompressed model format.
+
+The keys of the model are stored in a marisa trie (`<name>.trie`) and their
+counts in a numpy array (`<name>.counts.npy`) indexed by the key ids of the
+trie.  `<name>.order.npy` holds the key ids in sorted order of the keys, so
+that the model can be iterated in the same (sorted) order as a DAWG.
+All three files are opened with mmap, so opening a model takes milliseconds
+and all the processes that use the same model share one copy of it in the
+page cache.
+
+The files of a model are written under a new generation name,
+<name>.<gen>.trie etc., and <name>.trie is a symbolic link to the trie of
+the current generation.  Saving a model swaps the link with one rename, so
+a reader always opens the three files of one generation.  (Models written
+before were plain files without a generation, and are still read.)
+"""
+
+import os
+import re
+import time
+
+import marisa_trie
+import numpy as np
+
+
+# Number of times a reader retries when a generation is replaced while it
+# is being opened.
+OPEN_RETRIES = 3
+
+
+def _sibling(fname, ext):
+    base = fname[:-len('.trie')] if fname.endswith('.trie') else fname
+    return base + ext
+
+
+def _files(fname):
+    """The (trie, counts, order) files of the current generation of the
+    model @fname"""
+    trie = os.path.realpath(fname)
+    return trie, _sibling(trie, '.counts.npy'), _sibling(trie, '.order.npy')
+
+
+class MmapDAWG(object):
+    """Read only, memory mapped replacement of dawg.IntCompletionDAWG.
+    Supports the part of the DAWG interface used by the models.
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        for i in range(OPEN_RETRIES):
+            trief, countsf, orderf = _files(fname)
+            try:
+                trie = marisa_trie.Trie()
+                trie.mmap(trief)
+                counts = np.load(countsf, mmap_mode='r')
+                order = np.load(orderf, mmap_mode='r')
+                break
+            except FileNotFoundError:
+                # the generation was replaced (and removed) meanwhile
+                if i == OPEN_RETRIES - 1:
+                    raise
+        self._trie, self._counts, self._order = trie, counts, order
+
+    @staticmethod
+    def save(items, fname):
+        """Writes the (key, count) pairs in @items, which must be sorted by
+        key, to a new generation of the model @fname, and then points the
+        link @fname to it with one rename.  The files of the previous
+        generation are removed; the processes that have them open keep
+        their mappings.
+        """
+        keys, counts = [], []
+        for k, c in items:
+            keys.append(k)
+            counts.append(c)
+        trie = marisa_trie.Trie(keys)
+        order = np.fromiter((trie.key_id(k) for k in keys), dtype=np.int64,
+                            count=len(keys))
+        counts_by_id = np.zeros(len(keys), dtype=np.int64)
+        counts_by_id[order] = counts
+        gen = '{}.{:x}{:x}.trie'.format(_sibling(fname, ''), time.time_ns(),
+                                      os.getpid())
+        for ext, arr in [('.counts.npy', counts_by_id), ('.order.npy', order)]:
+            with open(_sibling(gen, ext), 'wb') as fout:
+                np.save(fout, arr)
+        trie.save(gen)
+        old = _files(fname) if os.path.lexists(fname) else ()
+        if old and not os.path.islink(fname):
+            old = old[1:]   # a plain trie file, replaced by the link
+        link = fname + '.tmp'
+        if os.path.lexists(link):
+            os.remove(link)
+        os.symlink(os.path.basename(gen), link)
+        os.replace(link, fname)
+        for f in old:
+            if os.path.exists(f):
+                os.remove(f)
+        return fname
+
+    @staticmethod
+    def remove(fname):
+        """Removes the model @fname: the link and the files of all its
+        generations (not only the current one, so that generations left
+        behind by a removed link are cleaned up too)."""
+        os.remove(fname)
+        d, base = os.path.split(_sibling(os.path.abspath(fname), ''))
+        gen = re.compile(re.escape(base) +
+                         r'(\.[0-9a-f]+)?\.(trie|counts\.npy|order\.npy)$')
+        for f in os.listdir(d):
+            if gen.match(f):
+                os.remove(os.path.join(d, f))
+
+    @staticmethod
+    def exists(fname):
+        return all(os.path.exists(f) for f in _files(fname))
+
+    def get(self, key, default=None):
+        i = self._trie.get(key)
+        if i is None:
+            return default
+        return int(self._counts[i])
+
+    def __getitem__(self, key):
+        return int(self._counts[self._trie.key_id(key)])
+
+    def __contains__(self, key):
+        return key in self._trie
+
+    def __len__(self):
+        return len(self._trie)
+
+    def iteritems(self, prefix=''):
+        """Yields (key, count) pairs of the keys starting with @prefix in
+        sorted order of the keys."""
+        if not prefix:
+            restore, step = self._trie.restore_key, 1 << 16
+            for s in range(0, len(self._order), step):
+                ids = self._order[s:s + step]
+                for i, c in zip(ids.tolist(), self._counts[ids].tolist()):
+                    yield restore(i), c
+            return
+        for k, i in sorted(self._trie.iteritems(prefix)):
+            yield k, int(self._counts[i])
+
+    def items(self, prefix=''):
+        return list(self.iteritems(prefix))
+
+    def iterkeys(self, prefix=''):
+        for k, _ in self.iteritems(prefix):
+            yield k
+
+    def keys(self, prefix=''):
+        return sorted(self._trie.keys(prefix))
+
+    def prefixes(self, key):
+        return self._trie.prefixes(key)
+
+    def compile_replaces(self, replaces):
+        return replaces
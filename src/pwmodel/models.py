@@ -8,56 +8,176 @@ import dawg
 import functools
 import pathlib
 import json
+import multiprocessing
 import string
+import tempfile
+import math
+import numpy as np
 
 from . import helper
 from .fast_fuzzysearch import fast_fuzzysearch
+from .mmapdawg import MmapDAWG
+from .ngramtable import NGramIndex, NGramSampler, NGramTable, MAX_PACKED_N
+from .guessnumber import GuessNumberEstimator
+from .rankindex import RankIndex
+from .pcfg import NONT_RE, PcfgGrammar, PcfgSampler, HEAP_SIZE
+from .countfile import (SpillCounter, merge_counts, merge_count_files,
+                        read_header, write_counts)
 
 TOTALF_W = '\x02__TOTALF__\x03'
 NPWS_W = '\x02__NPWS__\x03'
 reserved_words = {TOTALF_W, NPWS_W}
+# The context table of an NGramPw model also lists the characters of the
+# model, as the keys CHARS_W + c (see NGramPw._load_context_table).
+CHARS_W = '\x02__CHARS__\x03'
 # Valid characters for passwords
 # string.digits + string.ascii_letters + string.punctuation
 VALID_CHARS = set(string.printable[:-6] + helper.START + helper.END)
 N_VALID_CHARS = len(VALID_CHARS)
+# Number of passwords split together by _count_pws
+COUNT_BATCH = 10000
+# Number of samples of the guess number estimates
+MC_SAMPLES = 100000
+# Number of passwords sampled together by sample_pws
+SAMPLE_BATCH = 1 << 16
+# Maximum number of passwords held by iter_pws_in_order at a time, and how
+# often it saves its position
+BAND_SIZE = 1000000
+CHECKPOINT_EVERY = 100000
+# Number of passwords in every file written by write_pws_in_order
+CHUNK_PWS = 1000000
+# Smallest ratio between the two ends of a band of iter_pws_in_order
+MIN_BAND_RATIO = 1e-3
+
+
+def _count_pws(modelfunc, pws, topk, big_dict=None):
+    """Counts the splits (given by @modelfunc) of every (pw, c) pair in
+    @pws. Returns the count dictionary, the total frequency, the number of
+    passwords seen, and a heap with the @topk most frequent passwords.
+    @big_dict: the dictionary to count into, if it is a SpillCounter it is
+    spilled to disk whenever it grows too large.
+    """
+    if big_dict is None:
+        big_dict = defaultdict(int)
+    spill = getattr(big_dict, 'maybe_spill', None)
+    total_f, total_e = 0, 0
+    # Add topk passwords from the input dataset to the list
+    topk_pws = []
+    # modelfunc.many, if it exists, splits a list of passwords at once
+    many = getattr(modelfunc, 'many', None)
+    for chunk in _iter_chunks(pws, COUNT_BATCH):
+        splits = many([pw for pw, _ in chunk]) if many is not None \
+            else map(modelfunc, (pw for pw, _ in chunk))
+        for (pw, c), ngs in zip(chunk, splits):
+            for ng in ngs:
+                big_dict[ng] += c
+            total_f += c
+            total_e += 1
+            if spill is not None:
+                spill()
+            if len(big_dict) % 100000 == 0:
+                print(("Dictionary size: {} (Total_freq: {}; Total_pws: {}"\
+                       .format(len(big_dict), total_f, total_e)))
+            if len(topk_pws) >= topk:
+                heapq.heappushpop(topk_pws, (c, pw))
+            else:
+                heapq.heappush(topk_pws, (c, pw))
+    return big_dict, total_f, total_e, topk_pws
 
 
-def create_model(modelfunc, fname='', listw=[], outfname='',
-                 limit=int(3e6), min_pwlen=6, topk=10000, sep=r'\s+'):
-    """:modelfunc: is a function that takes a word and returns its
-    splits.  for ngram model this function returns all the ngrams of a
-    word, for PCFG it will return splits of the password.
-    @modelfunc: func: string -> [list of strings]
-    @fname: name of the file to read from
-    @listw: list of passwords. Used passwords from both the files and
-            listw if provided.
-    @outfname: the file to write down the model.
-    """
+# modelfunc of the worker processes, set once per worker by _init_worker, so
+# that it is not pickled again with every chunk.
+_worker_modelfunc = None
 
-    def length_filter(pw):
-        pw = ''.join(c for c in pw if c in VALID_CHARS)
-        return len(pw) >= min_pwlen
 
-    pws = []
-    if fname:
-        pws = helper.open_get_line(fname, limit=limit, pw_filter=length_filter, sep=sep)
+def _init_worker(modelfunc):
+    global _worker_modelfunc
+    _worker_modelfunc = modelfunc
+
+
+def _count_chunk(args):
+    chunk, topk = args
+    big_dict, total_f, total_e, topk_pws = _count_pws(_worker_modelfunc, chunk, topk)
+    return dict(big_dict), total_f, total_e, topk_pws
+
+
+# the model of the processes of NGramPw.iter_pws_in_order(workers > 1)
+_worker_model = None
+
+
+def _init_enum_worker(modelf, n):
+    global _worker_model
+    _worker_model = NGramPw('', T=read_dawg(modelf), n=n)
+    _worker_model._modelf = modelf
+
+
+def _enum_band(args):
+    lo, hi, limit, part = args
+    return _worker_model._band(lo, hi, limit, part)
+
+
+def _iter_chunks(pws, chunksize):
+    pws = iter(pws)
+    while True:
+        chunk = list(itertools.islice(pws, chunksize))
+        if not chunk:
+            return
+        yield chunk
 
-    big_dict = defaultdict(int)
+
+def _count_pws_parallel(modelfunc, pws, topk, workers, chunksize, big_dict=None):
+    """Same as _count_pws, but splits @pws into chunks of @chunksize
+    passwords, counts them in @workers processes and merges the partial
+    counts.
+    """
+    if big_dict is None:
+        big_dict = defaultdict(int)
+    spill = getattr(big_dict, 'maybe_spill', None)
     total_f, total_e = 0, 0
-    # Add topk passwords from the input dataset to the list
     topk_pws = []
-    for pw, c in itertools.chain(pws, listw):
-        for ng in modelfunc(pw):
-            big_dict[ng] += c
-        total_f += c
-        total_e += 1
-        if len(big_dict) % 100000 == 0:
-            print(("Dictionary size: {} (Total_freq: {}; Total_pws: {}"\
-                   .format(len(big_dict), total_f, total_e)))
-        if len(topk_pws) >= topk:
-            heapq.heappushpop(topk_pws, (c, pw))
-        else:
-            heapq.heappush(topk_pws, (c, pw))
+    with multiprocessing.Pool(workers, initializer=_init_worker,
+                              initargs=(modelfunc,)) as pool:
+        jobs = ((chunk, topk) for chunk in _iter_chunks(pws, chunksize))
+        for d, f, e, tpws in pool.imap_unordered(_count_chunk, jobs):
+            for k, v in d.items():
+                big_dict[k] += v
+            if spill is not None:
+                spill()
+            total_f += f
+            total_e += e
+            for c, pw in tpws:
+                if len(topk_pws) >= topk:
+                    heapq.heappushpop(topk_pws, (c, pw))
+                else:
+                    heapq.heappush(topk_pws, (c, pw))
+            print("Dictionary size: {} (Total_freq: {}; Total_pws: {}"
+                  .format(len(big_dict), total_f, total_e))
+    return big_dict, total_f, total_e, topk_pws
+
+
+def count_model(modelfunc, fname='', listw=[], limit=int(3e6), min_pwlen=6,
+                topk=10000, sep=r'\s+', workers=1, chunksize=100000,
+                max_dict_size=-1, tmpdir=None):
+    """Counts the splits (given by @modelfunc) of the passwords in the file
+    @fname and in @listw, and returns them as a SpillCounter, including the
+    @topk passwords and the NPWS_W and TOTALF_W totals.  See create_model
+    for the arguments.  The caller must close() the returned counter.
+    """
+    pws = []
+    if fname:
+        pws = helper.open_get_line(fname, limit=limit, min_len=min_pwlen,
+                                   charset=VALID_CHARS, sep=sep)
+
+    big_dict = SpillCounter(max_dict_size, tmpdir)
+    if workers > 1:
+        big_dict, total_f, total_e, topk_pws = _count_pws_parallel(
+            modelfunc, itertools.chain(pws, listw), topk, workers, chunksize,
+            big_dict=big_dict
+        )
+    else:
+        big_dict, total_f, total_e, topk_pws = _count_pws(
+            modelfunc, itertools.chain(pws, listw), topk, big_dict=big_dict
+        )
     # Adding topk password to deal with probability reduction of popular
     # passwords. Mostly effective for n-gram models
     print("topk={}".format(topk))
@@ -70,22 +190,154 @@ def create_model(modelfunc, fname='', listw=[], outfname='',
 
     big_dict[NPWS_W] = total_e
     big_dict[TOTALF_W] = total_f
+    return big_dict
+
+
+def is_mmap(fname):
+    """Whether @fname is (to be) a memory mapped model, see MmapDAWG"""
+    return fname.endswith('.trie')
+
 
-    nDawg = dawg.IntCompletionDAWG(big_dict)
+def save_model(T, outfname):
+    """Writes the model @T to @outfname atomically: it is written to a
+    temporary file in the same directory, which is then renamed.  If
+    @outfname ends with .trie, the model is written in the uncompressed
+    memory mapped format (see MmapDAWG).  Returns the file name.
+    """
     if not outfname:
         outfname = 'tmpmodel.dawg.gz'
-    elif not outfname.endswith('.gz'):
+    elif is_mmap(outfname):
+        pathlib.Path(outfname).parent.mkdir(parents=True, exist_ok=True)
+        return MmapDAWG.save(T.iteritems(), outfname)
+    elif not helper.codec_of(outfname):
         outfname += '.gz'
-    pathlib.Path(outfname).parent.mkdir(parents=True, exist_ok=True)
-    helper.save_dawg(nDawg, outfname)
+    outdir = pathlib.Path(outfname).parent
+    outdir.mkdir(parents=True, exist_ok=True)
+    fd, tmpf = tempfile.mkstemp(dir=str(outdir), suffix='.tmp.' +
+                                helper.codec_of(outfname))
+    os.close(fd)
+    try:
+        helper.save_dawg(T, tmpf)
+        os.replace(tmpf, outfname)
+    except BaseException:
+        os.remove(tmpf)
+        raise
+    return outfname
+
+
+def create_model(modelfunc, fname='', listw=[], outfname='',
+                 limit=int(3e6), min_pwlen=6, topk=10000, sep=r'\s+',
+                 workers=1, chunksize=100000, max_dict_size=-1, tmpdir=None):
+    """:modelfunc: is a function that takes a word and returns its
+    splits.  for ngram model this function returns all the ngrams of a
+    word, for PCFG it will return splits of the password.
+    @modelfunc: func: string -> [list of strings]
+    @fname: name of the file to read from
+    @listw: list of passwords. Used passwords from both the files and
+            listw if provided.
+    @outfname: the file to write down the model.
+    @workers: number of processes used for counting. With workers > 1 the
+            passwords are split into chunks of @chunksize passwords and
+            counted in parallel; the resulting model is the same.
+    @max_dict_size: if > 0, the count table is written to sorted runs in
+            @tmpdir whenever it holds that many keys, and the runs are merged
+            straight into the DAWG, which keeps the memory bounded.
+    """
+    big_dict = count_model(
+        modelfunc, fname=fname, listw=listw, limit=limit, min_pwlen=min_pwlen,
+        topk=topk, sep=sep, workers=workers, chunksize=chunksize,
+        max_dict_size=max_dict_size, tmpdir=tmpdir
+    )
+    try:
+        if big_dict.spilled():
+            nDawg = dawg.IntCompletionDAWG(big_dict.sorted_items(),
+                                           input_is_sorted=True)
+        else:
+            nDawg = dawg.IntCompletionDAWG(big_dict)
+    finally:
+        big_dict.close()
+    outfname = save_model(nDawg, outfname)
+    if is_mmap(outfname):
+        return read_dawg(outfname)
     return nDawg
 
 
 def read_dawg(fname):
     print(("reading {fname}".format(fname=fname)))
+    if is_mmap(fname):
+        if not MmapDAWG.exists(fname):
+            raise IOError("No such model: {!r}".format(fname))
+        return MmapDAWG(fname)
     return helper.load_dawg(fname, dawg.IntCompletionDAWG)
 
 
+def sidecar_path(modelf, name, ext=None):
+    """Returns the name of the file @name stored next to the model @modelf,
+    e.g., x/phpbb-ngram-3.dawg.gz -> x/phpbb-ngram-3.@name.dawg.gz, or, if
+    @ext is given, x/phpbb-ngram-3.@name@ext
+    """
+    if is_mmap(modelf):
+        base, mext = modelf[:-len('.trie')], '.trie'
+    elif modelf.rfind('.dawg') >= 0:
+        i = modelf.rfind('.dawg')
+        base, mext = modelf[:i], modelf[i:]
+    else:
+        base, mext = modelf, ''
+    return '{}.{}{}'.format(base, name, mext if ext is None else ext)
+
+
+def save_npz(fname, arrays):
+    """Writes the dict of numpy @arrays to @fname (an .npz file) through a
+    temporary file, so that readers never see a partial file."""
+    with open(fname + '.tmp', 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(fname + '.tmp', fname)
+
+
+def save_checkpoint(fname, state):
+    """Writes the dict @state to @fname as json, through a temporary file"""
+    with open(fname + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(fname + '.tmp', fname)
+
+
+def remove_model(fname):
+    """Removes the model file @fname, with all the files of a memory mapped
+    model (see MmapDAWG.remove)."""
+    if is_mmap(fname):
+        MmapDAWG.remove(fname)
+    else:
+        os.remove(fname)
+
+
+def model_file(fname):
+    """Returns the existing file of the model @fname (load_dawg also tries
+    @fname.gz etc.), or None"""
+    if is_mmap(fname):
+        return fname if MmapDAWG.exists(fname) else None
+    for f in [fname] + [fname + '.' + c for c in helper.CODECS]:
+        if os.path.exists(f):
+            return f
+    return None
+
+
+def context_totals(T, maxlen):
+    """Yields (h, sum of the frequencies of the keys that start with h) for
+    every key h of @T that is at most @maxlen long, in a single pass over
+    the keys of @T in sorted order.
+    """
+    stack = []   # [prefix, total] of the open prefixes of the current key
+    for k, v in T.iteritems():
+        while stack and not k.startswith(stack[-1][0]):
+            yield tuple(stack.pop())
+        for e in stack:
+            e[1] += v
+        if len(k) <= maxlen:
+            stack.append([k, v])
+    while stack:
+        yield tuple(stack.pop())
+
+
 def get_data_path(fname):
     data_dir = os.path.join(helper.home, '.pwmodel')
     if helper.DEBUG:
@@ -104,19 +356,34 @@ class PwModel(object):
         if not self._leak:
             self._leak = kwargs.get('leak', 'tmp')
             freshall = True
-        self._modelf = get_data_path(
-            '{}-{}.dawg.gz'.format(self._leak, self.modelname)
-        )
+        if kwargs.get('mmap', False):
+            self._modelf = get_data_path('{}-{}.trie'.format(
+                self._leak, self.modelname
+            ))
+        else:
+            self._modelf = get_data_path('{}-{}.dawg.{}'.format(
+                self._leak, self.modelname, kwargs.get('codec', 'gz')
+            ))
+        self._topk = kwargs.get('topk', -1)
+        self._modelfunc = kwargs.get('modelfunc', self.modelfunc)
         self._T = None
+        self._estimators = {}
+        # A model built from a given T is not the model in self._modelf
+        # until it is saved there (update), so it has no sidecar files.
+        self._saved = kwargs.get('T') is None
         if kwargs.get('T') is not None:
             self._T = kwargs.get('T')
             return
         if freshall:
             try:
-                os.remove(self._modelf)
+                remove_model(self._modelf)
             except OSError as e:
                 print("File ({!r}) does not exist. ERROR: {}"
                       .format(self._modelf, e), file=sys.stderr)
+            try:   # the context table of NGramPw
+                remove_model(sidecar_path(self._modelf, 'ctx'))
+            except FileNotFoundError:
+                pass
         if self._leak != 'tmp':
             try:
                 self._T = read_dawg(self._modelf)
@@ -127,15 +394,49 @@ class PwModel(object):
             self._T = create_model(
                 fname=pwfilename, listw=kwargs.get('listw', []),
                 outfname=self._modelf,
-                modelfunc=kwargs.get('modelfunc', self.modelfunc),
+                modelfunc=self._modelfunc,
                 limit=int(kwargs.get('limit', 3e6)),
-                topk=kwargs.get('topk', -1),
-                sep=kwargs.get('sep', r'\s+')
+                topk=self._topk,
+                sep=kwargs.get('sep', r'\s+'),
+                workers=int(kwargs.get('workers', 1)),
+                max_dict_size=int(kwargs.get('max_dict_size', -1))
             )
 
     def modelfunc(self, w):
         raise Exception("Not implemented")
 
+    def update(self, pwfilename='', listw=[], outfname='', **kwargs):
+        """Folds the passwords in the file @pwfilename and/or in @listw into
+        the model, and atomically writes the updated model to @outfname
+        (default: the model file).  Only the new passwords are read and
+        counted, and their counts (including NPWS_W and TOTALF_W) are added
+        to the ones in the model in a single merge pass.  For models with
+        topk > 0, the topk passwords of the new passwords are added.
+        @kwargs are passed to count_model, e.g., limit (default: -1, i.e.,
+        the whole file), sep, workers, max_dict_size.
+        """
+        kwargs.setdefault('limit', -1)
+        kwargs.setdefault('topk', self._topk)
+        delta = count_model(self._modelfunc, fname=pwfilename, listw=listw,
+                            **kwargs)
+        try:
+            T = dawg.IntCompletionDAWG(
+                merge_counts([self._T.iteritems(), delta.sorted_items()]),
+                input_is_sorted=True
+            )
+        finally:
+            delta.close()
+        self._modelf = save_model(T, outfname or self._modelf)
+        self._T = read_dawg(self._modelf) if is_mmap(self._modelf) else T
+        self._saved = True
+        self._estimators = {}
+        self._reset_caches()
+        return self
+
+    def _reset_caches(self):
+        """Called when self._T changes"""
+        pass
+
     def prob(self, word):
         raise Exception("Not implemented")
 
@@ -150,6 +451,61 @@ class PwModel(object):
         """Returns password probability"""
         return self.prob(pw)
 
+    def prob_many(self, pws):
+        """Returns the probabilities of the passwords in @pws (any iterable)
+        as a numpy array.  Every distinct password is scored only once.
+        """
+        index = {}
+        inv = np.fromiter((index.setdefault(pw, len(index)) for pw in pws),
+                          dtype=np.int64)
+        return self._prob_uniq(list(index))[inv]
+
+    def _prob_uniq(self, pws):
+        """Probabilities of the list of distinct passwords @pws"""
+        return np.fromiter((self.prob(pw) for pw in pws), dtype=float,
+                           count=len(pws))
+
+    def guess_number(self, pw, **kwargs):
+        """Monte Carlo estimate of the guess number of @pw (see
+        guessnumber.py); @kwargs go to guess_estimator."""
+        return float(self.guess_numbers([pw], **kwargs)[0])
+
+    def guess_numbers(self, pws, **kwargs):
+        """guess_number of every password in @pws, as a numpy array"""
+        return self.guess_estimator(**kwargs).guess_numbers(self.prob_many(pws))
+
+    def guess_estimator(self, n=MC_SAMPLES, seed=0):
+        """The guess number estimator built from @n samples of the model,
+        kept in <model>.mc-<n>-<seed>.npz."""
+        if not hasattr(self, 'sample_pws'):
+            raise NotImplementedError("{} cannot sample passwords".format(self))
+        key = (n, seed)
+        if key not in self._estimators:
+            self._estimators[key] = self._sidecar(
+                'mc-{}-{}'.format(n, seed), GuessNumberEstimator,
+                lambda: self._build_estimator(n, seed))
+        return self._estimators[key]
+
+    def _build_estimator(self, n, seed):
+        print("Sampling {} passwords for the guess number estimates".format(n))
+        return GuessNumberEstimator.build(self, n, seed=seed)
+
+    def _sidecar(self, name, cls, build):
+        """The @cls object (e.g., RankIndex) of the model, loaded from
+        <model>.@name.npz next to the model file, or built with @build() and
+        saved there if the file is missing or older than the model file.
+        Models without a model file of their own are never cached.
+        """
+        modelf = model_file(self._modelf) if self._saved else None
+        fname = sidecar_path(self._modelf, name, '.npz')
+        if modelf and os.path.exists(fname) and \
+           os.path.getmtime(fname) >= os.path.getmtime(modelf):
+            return cls.load(fname)
+        obj = build()
+        if modelf:
+            save_npz(fname, obj.arrays())
+        return obj
+
     def __str__(self):
         return 'Pwmodel<{}-{}>'.format(self.modelname, self._leak)
 
@@ -167,15 +523,66 @@ class PwModel(object):
 MIN_PROB = 1e-10
 
 
+def pcfgtokensofw(word):
+    """Splits @word into its base structure, nonterminals and terminals.
+    See PcfgPw.pcfgtokensofw.
+    """
+    return helper.pcfg_tokens(word)
+
+
+# the batch form, used by _count_pws
+pcfgtokensofw.many = helper.pcfg_tokens_many
+
+
 class PcfgPw(PwModel):
     """Creates a pcfg model from the password in @pwfilename. 
     """
 
     def __init__(self, pwfilename, **kwargs):
-        kwargs['modelfunc'] = self.pcfgtokensofw
+        kwargs['modelfunc'] = pcfgtokensofw
         kwargs['modelname'] = 'weir-pcfg'
         kwargs['topk'] = 10000
         super(PcfgPw, self).__init__(pwfilename=pwfilename, **kwargs)
+        self._grammar, self._sampler = None, None
+        self._build_index()
+
+    def _reset_caches(self):
+        self._grammar, self._sampler = None, None
+        self._build_index()
+
+    def _build_index(self):
+        """The total count of the base structures, and the count of every
+        nonterminal, so that prob and tokprob need no scans."""
+        self._total_s = float(sum(v for k, v in self._T.iteritems('__S__')))
+        self._nonts = {k: v for k, v in self._T.iteritems('__')
+                       if NONT_RE.match(k)}
+
+    def grammar(self):
+        """The grammar of the model (see pcfg.py), built on first use"""
+        if self._grammar is None:
+            self._grammar = PcfgGrammar(self._T)
+        return self._grammar
+
+    def sample_pws(self, n, seed=None, return_probs=False):
+        """Samples @n passwords from the grammar, in batches with precomputed
+        cumulative tables (see pcfg.PcfgSampler).
+        @seed: seed or numpy Generator, for reproducible samples.
+        @return_probs: also return the probability with which each password
+        was sampled, i.e., of the derivation that was drawn.  It equals
+        prob(pw), unless the drawn terminals are tokenized differently once
+        joined (e.g., 'ab' + '_' is the single token 'ab_').
+        """
+        if self._sampler is None:
+            self._sampler = PcfgSampler(self.grammar())
+        rng = np.random.default_rng(seed)
+        pws, probs = [], []
+        for i in range(0, n, SAMPLE_BATCH):
+            b, q = self._sampler.sample(min(SAMPLE_BATCH, n - i), rng)
+            pws.extend(b)
+            probs.append(q)
+        if return_probs:
+            return pws, np.concatenate(probs) if probs else np.empty(0)
+        return pws
 
     def pcfgtokensofw(self, word):
         """This splits the word into chunks similar to as described in Weir
@@ -185,12 +592,7 @@ class PcfgPw(PwModel):
         ['password', '@', '123', '__L8__', '__Y1__', '__D3__']
 
         """
-        tok = helper.tokens(word)
-
-        sym = ['__{0}{1}__'.format(helper.whatchar(w), len(w))
-               for w in tok]
-        S = ['__S__' + ''.join(sym).replace('_', '') + '__']
-        return S + sym + tok
+        return pcfgtokensofw(word)
 
     def tokprob(self, tok, nonT):
         """
@@ -198,7 +600,7 @@ class PcfgPw(PwModel):
         e.g., P[ W3 -> 'abc']
         """
 
-        p = self._T.get(tok, 0) / float(self._T.get(nonT, 1))
+        p = self._T.get(tok, 0) / float(self._nonts.get(nonT, 1))
         if not p:
             p = MIN_PROB
         return p
@@ -214,9 +616,9 @@ class PcfgPw(PwModel):
         l = len(tokens)
         assert l % 2 == 0, "Expecting even number of tokens!. got {}".format(tokens)
 
-        p = float(self._T.get(S, 0.0)) / sum(v for k, v in self._T.items('__S__'))
+        p = float(self._T.get(S, 0.0)) / self._total_s
         for i, t in enumerate(tokens):
-            f = self._T.get(t, 0.0)
+            f = self._nonts.get(t, 0.0) if i < l / 2 else self._T.get(t, 0.0)
             if f == 0:
                 return 0.0
             if i < l / 2:
@@ -226,6 +628,24 @@ class PcfgPw(PwModel):
                 # print pw, p, t, self._T.get(t)
         return p
 
+    def iter_pws_in_order(self, filter_func=None, heap_size=HEAP_SIZE):
+        """Yields (pw, prob) in non-increasing order of prob, following the
+        "next" function of Weir et al. over the pre-sorted terminals of
+        every nonterminal (see PcfgGrammar.iter_pws_in_order).  prob is
+        exactly self.prob(pw).
+        """
+        for pw, p in self.grammar().iter_pws_in_order(heap_size=heap_size):
+            if filter_func is None or filter_func(pw):
+                yield pw, p
+
+    def generate_pws_in_order(self, n, filter_func=None, N_max=1e6):
+        """Returns the @n most probable passwords (that pass @filter_func) as
+        a list of (pw, prob).  @N_max bounds the size of the queue."""
+        return list(itertools.islice(
+            self.iter_pws_in_order(filter_func=filter_func,
+                                   heap_size=int(N_max)), n
+        ))
+
 
 ################################################################################
 
@@ -241,6 +661,9 @@ class NGramPw(PwModel):
     'ngrams.dawg'
     :param pwfilename: a `password' file
     :param n: an integer (NOTE: you should provide a `n`.  `n` is default to 3)
+    :param dense: (n <= 4 only) compile the model into dense transition
+    tables (see ngramtable.py), and compute prob, _get_next and sample_pw
+    with array lookups.  Needs about 1.5KB of memory per context.
     """
 
     def __init__(self, pwfilename='', **kwargs):
@@ -251,13 +674,76 @@ class NGramPw(PwModel):
         kwargs['topk'] = -1
         super(NGramPw, self).__init__(pwfilename=pwfilename, **kwargs)
         self._leet = self._T.compile_replaces(helper.L33T)
+        # A model built from a given T has no model file to keep the
+        # context table next to.
+        self._ctx = self._load_context_table(fresh=kwargs.get('T') is not None,
+                                             save=kwargs.get('T') is None)
+        self._dense, self._sampler = None, None
+        self._index = None
+        if kwargs.get('dense', False):
+            self._dense = NGramTable(self._T, self._n, N_VALID_CHARS,
+                                     reserved_words)
+
+    def _reset_caches(self):
+        self._leet = self._T.compile_replaces(helper.L33T)
+        self.sum_freq.cache_clear()
+        self.get_freq.cache_clear()
+        self.prob.cache_clear()
+        self._next_dist.cache_clear()
+        self._successors.cache_clear()
+        self._alphabet.cache_clear()
+        self._ctx = self._load_context_table(fresh=True)
+        self._sampler = None
+        self._index = None
+        if self._dense is not None:
+            self._dense = NGramTable(self._T, self._n, N_VALID_CHARS,
+                                     reserved_words)
+
+    def _load_context_table(self, fresh=False, save=True):
+        """Returns the context table of the model (see context_totals), with
+        the characters of the model under CHARS_W.  It is stored next to the
+        model file, and rebuilt if it is missing or older than the model.
+        """
+        ctxf = sidecar_path(self._modelf, 'ctx')
+        modelf = model_file(self._modelf)
+        if not fresh and modelf and model_file(ctxf) and \
+           os.path.getmtime(model_file(ctxf)) >= os.path.getmtime(modelf):
+            ctx = read_dawg(model_file(ctxf))
+            if ctx.keys(CHARS_W):   # else, from before CHARS_W
+                return ctx
+        totals = list(context_totals(self._T, self._n - 1))
+        totals += [(CHARS_W + h, v) for h, v in totals if len(h) == 1]
+        ctx = dawg.IntCompletionDAWG(totals)
+        if save and modelf:
+            ctxf = save_model(ctx, ctxf)
+            if is_mmap(ctxf):
+                ctx = read_dawg(ctxf)
+        return ctx
+
+    def ngram_index(self):
+        """The packed n-gram counts used by prob_many (n <= MAX_PACKED_N,
+        see ngramtable.NGramIndex), kept in <model>.ngrams.npz."""
+        if self._index is None:
+            self._index = self._sidecar(
+                'ngrams', NGramIndex,
+                lambda: NGramIndex.build(self._T, self._n, reserved_words))
+        return self._index
 
     @functools.lru_cache(maxsize=100000)
     def sum_freq(self, pre):
+        """Sum of the frequencies of all the keys that start with @pre"""
         if not isinstance(pre, str):
             pre = str(pre)
+        f = self._ctx.get(pre)
+        if f is not None:
+            return float(f)
         return float(sum(v for k, v in self._T.iteritems(pre)))
 
+    def _next_total(self, history):
+        """Sum of the frequencies of the continuations of @history"""
+        return self.sum_freq(history) - self._T.get(history, 0) - \
+            sum(self._T[w] for w in reserved_words if w.startswith(history))
+
     @functools.lru_cache(maxsize=100000)
     def get_freq(self, x):
         """get freq of x  with or without L33t transformations """
@@ -313,24 +799,38 @@ class NGramPw(PwModel):
         orig_history = history
         if not history:
             return helper.START
+        if self._dense is not None:
+            return self._dense.next_dist(history)
         history = history[-(self._n-1):]
         while history and not self._T.get(history):
             history = history[1:]
-        kv = [(k, v) for k, v in self._T.items(history)
-              if not (k in reserved_words or k == history)]
-        total = sum(v for k, v in kv)
-        while total == 0 and len(history) > 0:
+        while history and self._next_total(history) == 0:
             history = history[1:]
-            kv = [(k, v) for k, v in self._T.items(history)
-                  if not (k in reserved_words or k == history)]
-            total = sum(v for k, v in kv)
-        assert total > 0, "Sorry there is no n-gram with {!r}".format(orig_history)
-        d = defaultdict(float)
+        assert history or self._next_total(history) > 0, \
+            "Sorry there is no n-gram with {!r}".format(orig_history)
+        return self._next_dist(history)
+
+    @functools.lru_cache(maxsize=100000)
+    def _next_dist(self, history):
+        """The characters seen after @history and their probabilities,
+        computed once per context.  The returned dict is shared, do not
+        modify it."""
         total = self._T.get(history)
-        for k, v in kv:
-            k = k[len(history):]
-            d[k] += (v+1)/(total + N_VALID_CHARS-1)
-        return d
+        return {c: (v + 1) / (total + N_VALID_CHARS - 1)
+                for c, v in self._children(history)}
+
+    @functools.lru_cache(maxsize=1)
+    def _alphabet(self):
+        """The characters of the model, from the context table"""
+        return [k[len(CHARS_W):] for k in self._ctx.keys(CHARS_W)]
+
+    def _children(self, h):
+        """[(c, f(h + c))] for the characters c seen after @h, in the order
+        of c.  It is one lookup per character of the model, instead of a walk
+        over all the keys that start with @h."""
+        get = self._T.get
+        kv = ((c, get(h + c)) for c in self._alphabet())
+        return [(c, v) for c, v in kv if v and h + c not in reserved_words]
 
     def _gen_next(self, history):
         """Generate next character sampled from the distribution of characters next.
@@ -338,6 +838,8 @@ class NGramPw(PwModel):
         orig_history = history
         if not history:
             return helper.START
+        if self._dense is not None:
+            return self._dense.sample_next(history)
         history = history[-(self._n-1):]
         kv = [(k, v) for k, v in self._T.items(history)
               if k not in reserved_words]
@@ -358,53 +860,239 @@ class NGramPw(PwModel):
             s += self._gen_next(s)
         return s[1:-1]
 
+    def sample_pws(self, n, seed=None, return_probs=False):
+        """Samples @n passwords, like sample_pw, in batches with precomputed
+        alias tables (see ngramtable.NGramSampler).
+        @seed: seed or numpy Generator, for reproducible samples.
+        @return_probs: also return the probability with which each password
+        was sampled (raw n-gram counts, not the smoothed prob()).
+        """
+        if self._sampler is None:
+            self._sampler = NGramSampler(self._T, self._n, reserved_words)
+        rng = np.random.default_rng(seed)
+        pws, probs = [], []
+        for i in range(0, n, SAMPLE_BATCH):
+            b, q = self._sampler.sample(min(SAMPLE_BATCH, n - i), rng)
+            pws.extend(b)
+            probs.append(q)
+        if return_probs:
+            return pws, np.concatenate(probs) if probs else np.empty(0)
+        return pws
+
     def generate_pws_in_order(self, n, filter_func=None, N_max=1e6):
         """
-        Generates passwords in order between upto N_max
-        @N_max is the maximum size of the priority queue will be tolerated,
-        so if the size of the queue is bigger than 1.5 * N_max, it will shrink
-        the size to 0.75 * N_max
-        @n is the number of password to generate.
-        **This function is expensive, and shuold be called only if necessary.
-        Cache its call as much as possible**
-        # TODO: Need to recheck how to make sure this is working.
+        Returns the @n most probable passwords (that pass @filter_func) as a
+        list of (pw, prob), in non-increasing order of prob.
+        @N_max is the maximum number of passwords held in memory at a time
+        (see iter_pws_in_order).
         """
-        # assert alpha < beta, 'alpha={} must be less than beta={}'.format(alpha, beta)
-        states = [(-1.0, helper.START)]
-        # get the topk first
-        p_min = 1e-9 / (n**2)   # max 1 million entries in the heap 
-        ret = []
-        done = set()
-        already_added_in_heap = set()
-        while len(ret) < n and len(states) > 0:
-        # while n > 0 and len(states) > 0:
-            p, s = heapq.heappop(states)
-            if p < 0:
-                p = -p
-            if s in done: continue
-            assert s[0] == helper.START, "Broken s: {!r}".format(s)
-            if s[-1] == helper.END:
-                done.add(s)
-                clean_s = s[1:-1]
-                if filter_func is None or filter_func(clean_s):
-                    ret.append((clean_s, p))
-                    # n -= 1
-                    # yield (clean_s, p)
-            else:
-                for c, f in self._get_next(s).items():
-                    if (f*p < p_min or (s+c) in done or
-                        (s+c) in already_added_in_heap):
-                        continue
-                    already_added_in_heap.add(s+c)
-                    heapq.heappush(states, (-f*p, s+c))
-            if len(states) > N_max * 3 / 2:
-                print("Heap size: {}. ret={}. (expected: {}) s={!r}"
-                      .format(len(states), len(ret), n, s))
-                print("The size of states={}.  Still need={} pws. Truncating"
-                      .format(len(states), n - len(ret)))
-                states = heapq.nsmallest(int(N_max * 3/4), states)
-                print("Done")
-        return ret
+        return list(itertools.islice(
+            self.iter_pws_in_order(filter_func=filter_func,
+                                   band_size=int(N_max)), n
+        ))
+
+    def iter_pws_in_order(self, min_prob=0.0, filter_func=None,
+                          checkpoint=None, band_size=BAND_SIZE, workers=1):
+        """
+        Yields (pw, prob) in non-increasing order of prob, down to @min_prob
+        (or forever, if it is 0).  Only the transitions seen in the model are
+        followed, and prob is exactly self.prob(pw).
+
+        The passwords are enumerated in bands of probability [lo, hi): every
+        band is a depth first search of the prefixes with probability >= lo
+        (the probability of a prefix bounds that of its completions), and
+        only the passwords of the band are held and sorted.  A band with more
+        than @band_size passwords is narrowed and searched again, so the
+        memory stays bounded.
+
+        @checkpoint: a file to save the position to, every CHECKPOINT_EVERY
+        passwords and when the generator is closed.  If the file exists, the
+        enumeration resumes from the saved position; at most
+        CHECKPOINT_EVERY passwords are yielded again after a crash.
+
+        @workers: if > 1, every band is searched by that many processes,
+        each over a part of the passwords split by their first two
+        characters, and their sorted outputs are merged.  The model must be
+        saved in its model file.
+        """
+        state = self._load_checkpoint(checkpoint)
+
+        def save():
+            if checkpoint:
+                save_checkpoint(checkpoint, state)
+
+        try:
+            yield from self._pws_in_order(state, save, min_prob, filter_func,
+                                          band_size, workers)
+        finally:
+            save()
+
+    def _load_checkpoint(self, checkpoint):
+        """The state of iter_pws_in_order saved in @checkpoint, or the state
+        of a new enumeration if there is no such file."""
+        state = {'modelf': self._modelf, 'hi': float('inf'), 'ratio': 0.01,
+                 'lo': None, 'pos': 0}
+        if checkpoint and os.path.exists(checkpoint):
+            with open(checkpoint) as f:
+                state = json.load(f)
+            if state['modelf'] != self._modelf:
+                raise ValueError("{!r} is a checkpoint of {!r}, not of {!r}"
+                                 .format(checkpoint, state['modelf'], self._modelf))
+            print("Resuming from {!r}: {}".format(checkpoint, state))
+        return state
+
+    def _pws_in_order(self, state, save, min_prob, filter_func, band_size,
+                      workers):
+        """The enumeration of iter_pws_in_order from (and updating) @state.
+        When a password is yielded, @state is the position right after it.
+        @save() is called every CHECKPOINT_EVERY passwords and at the end of
+        every band."""
+        def next_lo(hi, ratio):
+            # the first band is [ratio, inf)
+            return max(min_prob, ratio if hi == float('inf') else hi * ratio)
+
+        pool, band_f = None, self._band
+        if workers > 1:
+            if not model_file(self._modelf):
+                raise ValueError("Save the model to use workers: {!r} does "
+                                 "not exist".format(self._modelf))
+            pool = multiprocessing.Pool(workers, initializer=_init_enum_worker,
+                                        initargs=(self._modelf, self._n))
+            band_f = functools.partial(self._band_parallel, pool,
+                                       self._partitions(workers * 4))
+        try:
+            while state['hi'] > min_prob:
+                hi, ratio = state['hi'], state['ratio']
+                if state['lo'] is not None:   # resuming inside the band
+                    lo = state['lo']
+                    band = band_f(lo, hi, float('inf'))
+                else:
+                    lo = next_lo(hi, ratio)
+                    band = band_f(lo, hi, band_size)
+                    while band is None:   # too many passwords, narrow it
+                        ratio = math.sqrt(ratio)
+                        lo = next_lo(hi, ratio)
+                        band = band_f(lo, hi, band_size)
+                state['lo'], state['ratio'] = lo, ratio
+                for i in range(state['pos'], len(band)):
+                    pw, p = band[i]
+                    state['pos'] = i + 1
+                    if filter_func is None or filter_func(pw):
+                        yield pw, p
+                    if state['pos'] % CHECKPOINT_EVERY == 0:
+                        save()
+                if len(band) < band_size // 4:   # widen the next band
+                    ratio = max(ratio * ratio, MIN_BAND_RATIO)
+                state.update(hi=lo, lo=None, pos=0, ratio=ratio)
+                save()
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+    def write_pws_in_order(self, outdir, n, chunk_size=CHUNK_PWS,
+                           checkpoint=None, min_prob=0.0, filter_func=None,
+                           band_size=BAND_SIZE, workers=1):
+        """Writes the @n most probable passwords (see iter_pws_in_order) to
+        @outdir, in files of @chunk_size lines of "<pw>\t<prob>".  A chunk
+        file (guesses-<i>.txt) appears only once it is complete, so the files
+        can be consumed while the rest are being generated.  Returns the list
+        of the files.
+
+        @checkpoint: a file to save the position to after every chunk file.
+        If the file exists, the writing resumes with the next chunk file.
+        """
+        os.makedirs(outdir, exist_ok=True)
+        state = self._load_checkpoint(checkpoint)
+        state.setdefault('chunk', 0)
+        state.setdefault('written', 0)
+
+        def chunk_file(i):
+            return os.path.join(outdir, 'guesses-{:06d}.txt'.format(i))
+
+        fnames = [chunk_file(i) for i in range(state['chunk'])]
+        pws = self._pws_in_order(state, lambda: None, min_prob, filter_func,
+                                 band_size, workers)
+        it = itertools.islice(pws, max(n - state['written'], 0))
+        try:
+            while True:
+                chunk = list(itertools.islice(it, chunk_size))
+                if not chunk:
+                    break
+                fname = chunk_file(state['chunk'])
+                with open(fname + '.tmp', 'w') as f:
+                    f.writelines('{}\t{!r}\n'.format(pw, p) for pw, p in chunk)
+                os.replace(fname + '.tmp', fname)
+                fnames.append(fname)
+                # @state is right after the last password of the chunk
+                state['chunk'] += 1
+                state['written'] += len(chunk)
+                if checkpoint:
+                    save_checkpoint(checkpoint, state)
+        finally:
+            pws.close()
+        return fnames
+
+    def _partitions(self, k):
+        """Splits the passwords into (at most) @k parts of about the same
+        probability mass by their first two characters.  A part is the set of
+        the allowed values of pw[:1] and (pw + END)[:2]."""
+        heads = []
+        for c1, f1 in self._successors(helper.START):
+            if c1 == helper.END:
+                heads.append((f1, c1))
+                continue
+            for c2, f2 in self._successors((helper.START + c1)[-(self._n - 1):]):
+                heads.append((f1 * f2, c1 + c2))
+        parts = [(0.0, i, set()) for i in range(k)]
+        for f, head in sorted(heads, reverse=True):
+            mass, i, part = heapq.heappop(parts)
+            part.update([head, head[:1]])
+            heapq.heappush(parts, (mass + f, i, part))
+        return [frozenset(part) for _, _, part in sorted(parts) if part]
+
+    def _band_parallel(self, pool, parts, lo, hi, limit):
+        """Same as _band, but every part (see _partitions) is searched by a
+        process in @pool."""
+        bands = pool.map(_enum_band, [(lo, hi, limit, part) for part in parts])
+        if any(b is None for b in bands) or \
+           (sum(map(len, bands)) > limit and lo < hi * (1 - 1e-9)):
+            return None
+        return list(heapq.merge(*bands, key=lambda x: (-x[1], x[0])))
+
+    def _band(self, lo, hi, limit, part=None):
+        """The passwords with lo <= prob < hi, sorted in decreasing order of
+        prob (and then by the password), or None if there are more than
+        @limit of them.
+        @part: only the passwords of this part (see _partitions)."""
+        band = []
+        stack = [(1.0, helper.START, helper.START)]
+        while stack:
+            p, s, h = stack.pop()
+            for c, f in self._successors(h):
+                q = p * f
+                if q < lo:
+                    break
+                if part is not None and len(s) <= 2 and s[1:] + c not in part:
+                    continue
+                if c == helper.END:
+                    if q < hi:
+                        band.append((s[1:], q))
+                        if len(band) > limit and lo < hi * (1 - 1e-9):
+                            return None
+                else:
+                    stack.append((q, s + c, (h + c)[-(self._n - 1):]))
+        band.sort(key=lambda x: (-x[1], x[0]))
+        return band
+
+    @functools.lru_cache(maxsize=100000)
+    def _successors(self, h):
+        """[(c, P[c | h])] for the characters c seen after the context @h (a
+        key of the model), in decreasing order of the probability.  The
+        next context is (h + c)[-(n-1):]."""
+        d = self.get_freq(h)
+        return sorted(((c, (v + 1) / (d + N_VALID_CHARS - 1))
+                       for c, v in self._children(h)),
+                      key=lambda x: -x[1])
 
     def _get_largest_prefix(self, pw):
         s = self._T.prefixes(pw)
@@ -434,9 +1122,60 @@ class NGramPw(PwModel):
 
     @functools.lru_cache(maxsize=100000)
     def prob(self, pw):
+        if self._dense is not None:
+            p = self._dense.prob(pw)
+            if p is not None:
+                return p
         new_pw = helper.START + pw + helper.END
         return self._prob(new_pw)
 
+    def _prob_uniq(self, pws):
+        """Same as prob, for models whose keys are at most n long (as built
+        by NGramPw).  For n <= MAX_PACKED_N the counts of all the n-grams of
+        all the passwords are found with binary searches over the packed
+        keys (see ngram_index), all in numpy.  Otherwise the (history,
+        character) n-grams of all the passwords are collected first, the
+        factor P[c | history] of every distinct n-gram is computed once, and
+        the per password products are done in log space with numpy.  The
+        packed path is about 15x faster than calling prob for every
+        password; the n > MAX_PACKED_N path only about 3x, as its n-grams
+        are still looked up one at a time.
+        """
+        if self._dense is not None:
+            probs = self._dense.prob_many(pws)
+        elif self._n <= MAX_PACKED_N:
+            probs = np.exp(self.ngram_index().logprobs(pws, N_VALID_CHARS))
+        else:
+            probs = None
+        if probs is not None:
+            for i in np.flatnonzero(np.isnan(probs)):
+                probs[i] = self.prob(pws[i])
+            return probs
+        n, get, V = self._n, self._T.get, N_VALID_CHARS - 1
+        ngrams, lens = [], np.empty(len(pws), dtype=np.int64)
+        for i, pw in enumerate(pws):
+            s = helper.START + pw + helper.END
+            # the first characters have shorter histories
+            ngrams.extend([s[:k] for k in range(2, min(n - 1, len(s)) + 1)])
+            ngrams.extend(helper.ngramsofw(pw, n, n))
+            lens[i] = len(s) - 1
+        index = dict.fromkeys(ngrams)
+        index = dict(zip(index, range(len(index))))
+        ids = np.fromiter(map(index.__getitem__, ngrams), dtype=np.int64,
+                          count=len(ngrams))
+        if len(pws) == 0:
+            return np.empty(0)
+        zeros = itertools.repeat(0)
+        f = np.fromiter(map(get, index, zeros), dtype=float, count=len(index))
+        d = np.fromiter(map(get, map(operator.itemgetter(slice(None, -1)), index),
+                            zeros), dtype=float, count=len(index))
+        cp = (f + 1) / (d + V)
+        uniq = list(index)
+        for k in np.flatnonzero(d == 0):  # backoff
+            cp[k] = self.cprob(uniq[k][-1], uniq[k][:-1])
+        logp = np.add.reduceat(np.log(cp)[ids], np.cumsum(lens) - lens)
+        return np.exp(logp)
+
 
 def normalize(pw):
     """ Lower case, and change the symbols to closest characters"""
@@ -453,7 +1192,6 @@ class HistPw(PwModel):
     """
 
     def __init__(self, pwfilename, fuzzysearch=False, **kwargs):
-        kwargs['modelfunc'] = lambda x: [x]
         kwargs['modelname'] = 'histogram'
         super(HistPw, self).__init__(pwfilename=pwfilename, **kwargs)
         self.sep = kwargs.get('sep', r'\s+')
@@ -462,6 +1200,57 @@ class HistPw(PwModel):
             self.ffs = fast_fuzzysearch(self._T.keys(), ed=2)
         else:
             self.ffs = None
+        self._ranks = None
+
+    def modelfunc(self, w):
+        return [w]
+
+    def _reset_caches(self):
+        if self.ffs is not None:
+            self.ffs = fast_fuzzysearch(self._T.keys(), ed=2)
+        self._ranks = None
+
+    def rank_index(self):
+        """The frequency rank index of the passwords (see rankindex.py),
+        kept in <model>.rank.npz."""
+        if self._ranks is None:
+            self._ranks = self._sidecar('rank', RankIndex, self._build_ranks)
+        return self._ranks
+
+    def _build_ranks(self):
+        print("Building the rank index of {}".format(self))
+        return RankIndex.build(self._T, reserved_words)
+
+    def qth_pw(self, q):
+        """
+        returns the qth (0-based) most probable password as (pw, count).
+        Passwords with the same count are ranked in sorted order.
+        """
+        return self.rank_index().pw(q)
+
+    def top(self, k):
+        """[(pw, count)] of the @k most probable passwords"""
+        return self.rank_index().range(0, k)
+
+    def rank_range(self, a, b):
+        """[(pw, count)] of the passwords with rank in [@a, @b)"""
+        return self.rank_index().range(a, b)
+
+    def guess_numbers(self, pws, **kwargs):
+        """The exact guess numbers of @pws, from the rank index: 1 + the
+        number of passwords with a larger count (see RankIndex.guess_numbers).
+        The passwords not in the model come after all the others."""
+        get = self._T.get
+        freqs = np.fromiter((0 if pw in reserved_words else get(pw, 0)
+                             for pw in pws), dtype=np.int64)
+        return self.rank_index().guess_numbers(freqs)
+
+    def rank_of(self, pw):
+        """The rank of @pw (see qth_pw), or None if it is not in the model"""
+        f = self._T.get(pw, 0)
+        if not f or pw in reserved_words:
+            return None
+        return self.rank_index().rank(pw, f)
 
     def similarpws(self, pw, ed=2):
         return self.ffs.query(pw, ed)
@@ -478,6 +1267,11 @@ class HistPw(PwModel):
         """
         return float(self._T.get(pw, 0)) / self._T[TOTALF_W]
 
+    def _prob_uniq(self, pws):
+        get = self._T.get
+        return np.fromiter((get(pw, 0) for pw in pws), dtype=float,
+                           count=len(pws)) / self._T[TOTALF_W]
+
     def prob_correction(self, f=1):
         """
         Corrects the probability error due to truncating the distribution.
@@ -489,6 +1283,75 @@ class HistPw(PwModel):
         return helper.open_get_line(self.pwfilename, limit=n, sep=self.sep)
 
 
+def histfunc(word):
+    return [word]
+
+
+def model_spec(modelname):
+    """Returns the model class, the modelfunc and the topk used by the model
+    named @modelname, e.g., 'ngram-4', 'weir-pcfg' or 'histogram'.
+    """
+    if modelname == 'histogram':
+        return HistPw, histfunc, -1
+    if modelname == 'weir-pcfg':
+        return PcfgPw, pcfgtokensofw, 10000
+    if modelname.startswith('ngram-'):
+        n = int(modelname.split('-', 1)[1])
+        return NGramPw, functools.partial(helper.ngramsofw, n=1, maxn=n), -1
+    raise ValueError("Unknown model: {!r}".format(modelname))
+
+
+def create_partial(modelname, fname='', listw=[], outfname='', **kwargs):
+    """Counts the passwords in the file @fname (and @listw) for the model
+    @modelname, and writes the counts to the partial count file @outfname.
+    Partial count files of different shards of a leak can be combined into
+    one model with merge_models.  @kwargs are passed to count_model, e.g.,
+    limit (default: -1, i.e., the whole file).  Each shard adds its own topk
+    passwords.
+    Returns the header of the written file.
+    """
+    _, modelfunc, topk = model_spec(modelname)
+    kwargs.setdefault('limit', -1)
+    kwargs.setdefault('topk', topk)
+    counts = count_model(modelfunc, fname=fname, listw=listw, **kwargs)
+    header = {'modelname': modelname, 'npws': counts[NPWS_W],
+              'totalf': counts[TOTALF_W]}
+    try:
+        pathlib.Path(outfname).parent.mkdir(parents=True, exist_ok=True)
+        write_counts(outfname, counts.sorted_items(), header=header)
+    finally:
+        counts.close()
+    return header
+
+
+def merge_models(fnames, leak='merged', outfname='', tmpdir=None, codec='gz'):
+    """Merges the partial count files @fnames (see create_partial) into one
+    model, saves it in @outfname (default: the model file of @leak), and
+    returns the model.  The files are streamed through a k-way merge, with
+    a bounded number of open files, so the memory does not depend on the
+    number of files.
+    """
+    headers = [read_header(f) for f in fnames]
+    modelnames = set(h['modelname'] for h in headers)
+    if len(modelnames) != 1:
+        raise ValueError("Cannot merge different models: {}".format(modelnames))
+    modelname = modelnames.pop()
+    cls, _, _ = model_spec(modelname)
+    T = dawg.IntCompletionDAWG(merge_count_files(fnames, tmpdir=tmpdir),
+                               input_is_sorted=True)
+    if not outfname:
+        outfname = get_data_path('{}-{}.dawg.{}'.format(leak, modelname, codec))
+    outfname = save_model(T, outfname)
+    if is_mmap(outfname):
+        T = read_dawg(outfname)
+    kwargs = {'T': T, 'leak': leak}
+    if cls is NGramPw:
+        kwargs['n'] = int(modelname.split('-', 1)[1])
+    pwm = cls('', **kwargs)
+    pwm._modelf = outfname
+    return pwm
+
+
 if __name__ == "__main__":
     import sys
 
@@ -0,0 +1,391 @@
+"""Dense transition tables for low order n-gram models.
+
+For n <= 4 every context of an n-gram model (a key of length 1..n-1 with a
+nonzero count) can be given an integer id, and the whole model fits in two
+arrays indexed by (context id, character id):
+  P[h, c]    = P[c | h], the add-1 smoothed probability used by NGramPw.cprob
+  NEXT[h, c] = the context that NGramPw.cprob backs off to after seeing c in
+               the context h, i.e., the longest suffix of h+c that is at most
+               n-1 long and has a nonzero count.
+The next context is determined by (h, c) alone, so the probability of a
+password is a walk over NEXT that multiplies the entries of P.  This gives
+exactly the probabilities of NGramPw._prob, without string slicing or DAWG
+lookups.
+"""
+
+import random
+
+import numpy as np
+
+from . import helper
+
+try:
+    from ._fast import ngram_logprobs
+except ImportError:   # an old build of the extension
+    ngram_logprobs = None
+
+# Largest n for which a dense table is built; the tables grow as 96^(n-1).
+MAX_DENSE_N = 4
+# NGramIndex packs a key of up to MAX_PACKED_N characters of the basic
+# multilingual plane into a uint64, 16 bits per character.
+MAX_PACKED_N = 4
+
+
+class NGramTable(object):
+    """Dense form of the n-gram counts in @T (a DAWG of an NGramPw model).
+    The alphabet of the table is the set of characters that appear in @T;
+    passwords with any other character are not handled by the table.
+    @nchars: the size of the alphabet assumed by the add-1 smoothing
+    (N_VALID_CHARS).
+    @reserved: the keys of @T that are not n-grams.
+    """
+
+    def __init__(self, T, n, nchars, reserved=()):
+        if n > MAX_DENSE_N:
+            raise ValueError("Dense tables are only built for n <= {} (n={})"
+                             .format(MAX_DENSE_N, n))
+        self.n = n
+        self.contexts = {}   # context -> context id
+        tot, rows, cols, vals = [], [], [], []
+        for k, v in T.iteritems():
+            if k in reserved or len(k) > n or not v:
+                continue
+            if len(k) < n:
+                self.contexts[k] = len(tot)
+                tot.append(v)
+            if len(k) > 1:
+                rows.append(self.contexts[k[:-1]])
+                cols.append(k[-1])
+                vals.append(v)
+        self.chars = ''.join(sorted(h for h in self.contexts if len(h) == 1))
+        self._cid = {c: i for i, c in enumerate(self.chars)}
+        self.char_ids = np.full(max(map(ord, self.chars)) + 1, -1, dtype=np.int32)
+        for i, c in enumerate(self.chars):
+            self.char_ids[ord(c)] = i
+        self.tot = np.array(tot, dtype=np.float64)
+        counts = np.zeros((len(tot), len(self.chars)), dtype=np.float64)
+        counts[rows, [self._cid[c] for c in cols]] = vals
+        self.P = (counts + 1) / (self.tot[:, None] + nchars - 1)
+        self.next = self._build_next(counts)
+        self.counts = counts.astype(np.min_scalar_type(counts.max()))
+        self.start = self.contexts[helper.START]
+
+    def _char_id(self, c):
+        return self._cid.get(c, -1)
+
+    def _build_next(self, counts):
+        """NEXT[h, c] is h+c if that is a context, or else NEXT[h[1:], c].
+        The contexts are filled in order of their length, so the row of h[1:]
+        is always final when h is filled.
+        """
+        nxt = np.full(counts.shape, -1, dtype=np.int32)
+        bylen = [[] for _ in range(self.n)]
+        for h, i in self.contexts.items():
+            bylen[len(h)].append(h)
+        unigram = np.full(counts.shape[1], -1, dtype=np.int32)
+        for c in bylen[1]:
+            unigram[self._char_id(c)] = self.contexts[c]
+        for h, i in self.contexts.items():
+            if len(h) + 1 < self.n:
+                for j in np.flatnonzero(counts[i]):
+                    nxt[i, j] = self.contexts.get(h + self.chars[j], -1)
+        for l in range(1, self.n):
+            if not bylen[l]:
+                continue
+            ids = np.array([self.contexts[h] for h in bylen[l]], dtype=np.int64)
+            if l == 1:
+                back = np.broadcast_to(unigram, (len(ids), len(unigram)))
+            else:
+                back = nxt[[self.contexts[h[1:]] for h in bylen[l]]]
+            nxt[ids] = np.where(nxt[ids] >= 0, nxt[ids], back)
+        return nxt
+
+    def encode(self, s):
+        """Character ids of the string @s; -1 for the characters outside the
+        alphabet."""
+        o = np.frombuffer(s.encode('utf-32-le'), dtype=np.uint32)
+        ids = np.full(len(o), -1, dtype=np.int64)
+        known = o < len(self.char_ids)
+        ids[known] = self.char_ids[o[known]]
+        return ids
+
+    def state(self, history):
+        """Context id of @history, i.e., of its longest suffix (at most n-1
+        long) with a nonzero count; -1 if there is none."""
+        history = history[-(self.n - 1):]
+        while history and history not in self.contexts:
+            history = history[1:]
+        return self.contexts.get(history, -1)
+
+    def prob(self, pw):
+        """Probability of @pw, or None if @pw cannot be scored by the table"""
+        try:
+            ids = [self._cid[c] for c in pw]
+        except KeyError:
+            return None
+        ids.append(self._cid[helper.END])
+        P, nxt, h, p = self.P.item, self.next.item, self.start, 1.0
+        for c in ids:
+            p *= P(h, c)
+            h = nxt(h, c)
+        return p
+
+    def prob_many(self, pws):
+        """Probabilities of the list of passwords @pws; nan for the passwords
+        that cannot be scored by the table.  The walk runs in the compiled
+        kernel (_fast.ngram_logprobs) without the GIL, so several threads can
+        score batches at the same time.
+        """
+        if len(pws) == 0:
+            return np.empty(0)
+        ids, lens = self._encode_many(pws)
+        if ngram_logprobs is None:
+            return np.exp(self._logprobs(ids, lens))
+        logp = np.empty(len(pws))
+        ngram_logprobs(self.P, self.next, ids, lens, self.start, logp)
+        return np.exp(logp)
+
+    def _logprobs(self, ids, lens):
+        """numpy version of _fast.ngram_logprobs.  All the passwords are
+        walked over the tables together, one position at a time."""
+        ok = (ids >= 0).all(axis=1)
+        # longest first, so that the passwords still being walked at any
+        # position are a prefix of the rows
+        order = np.argsort(-lens, kind='stable')
+        ids, lens = np.where(ok[:, None], ids, 0)[order], lens[order]
+        nalive = len(lens) - np.searchsorted(lens[::-1], np.arange(ids.shape[1]),
+                                             side='right')
+        logp = np.zeros(len(lens))
+        h = np.full(len(lens), self.start, dtype=np.int64)
+        for j in range(ids.shape[1]):
+            k = nalive[j]
+            c = ids[:k, j]
+            logp[:k] += np.log(self.P[h[:k], c])
+            h[:k] = self.next[h[:k], c]
+        res = np.empty(len(lens))
+        res[order] = logp
+        res[~ok] = np.nan
+        return res
+
+    def _encode_many(self, pws):
+        """Character ids of the passwords (followed by END) in a matrix with
+        one row per password, padded with 0, and the length of every row."""
+        lens = np.fromiter(map(len, pws), dtype=np.intp, count=len(pws)) + 1
+        flat = self.encode(helper.END.join(pws) + helper.END)
+        ids = np.zeros((len(pws), lens.max()), dtype=np.int32)
+        starts = np.cumsum(lens) - lens
+        rows = np.repeat(np.arange(len(pws)), lens)
+        ids[rows, np.arange(len(flat)) - starts[rows]] = flat
+        return ids, lens
+
+    def next_dist(self, history):
+        """{c: P[c | history]} for the characters seen after @history"""
+        h = self.state(history)
+        cs = np.flatnonzero(self.counts[h])
+        return dict(zip((self.chars[j] for j in cs), self.P[h, cs].tolist()))
+
+    def sample_next(self, history):
+        """Samples the next character after @history, proportional to the
+        counts of the n-grams (without smoothing)."""
+        cum = np.cumsum(self.counts[self.state(history)], dtype=np.int64)
+        return self.chars[int(np.searchsorted(cum, random.random() * cum[-1],
+                                              side='right'))]
+
+
+class NGramSampler(object):
+    """Alias tables for sampling passwords from the n-gram counts in @T, for
+    any n >= 2.  The next character after the context h is drawn with
+    probability f(h+c) / sum_c' f(h+c'), i.e., the raw counts as in
+    NGramPw.sample_pw, without smoothing.  Only the transitions seen in @T
+    are followed, so no backoff is needed: the context after c is the last
+    n-1 characters of h+c.
+    The entries of all the contexts are stored in flat arrays; the entries
+    of the context h are at off[h]..off[h]+size[h].
+    """
+
+    def __init__(self, T, n, reserved=()):
+        if n < 2:
+            raise ValueError("Cannot sample from a {}-gram model".format(n))
+        self.n = n
+        contexts = {}
+        rows, chars, counts, nexts = [], [], [], []
+        for k, v in T.iteritems():
+            if k in reserved or len(k) > n or not v:
+                continue
+            if len(k) < n and not k.endswith(helper.END):
+                contexts[k] = len(contexts)
+            if len(k) > 1:
+                rows.append(k[:-1])
+                chars.append(k[-1])
+                counts.append(v)
+                nexts.append(k[-(n - 1):])
+        rows = np.array([contexts[h] for h in rows], dtype=np.int64)
+        order = np.argsort(rows, kind='stable')
+        self.size = np.bincount(rows, minlength=len(contexts))
+        self.off = np.cumsum(self.size) - self.size
+        self.chars = np.array([ord(c) for c in chars], dtype=np.uint32)[order]
+        self.next = np.array([contexts.get(h, -1) for h in nexts],
+                             dtype=np.int64)[order]
+        counts = np.array(counts, dtype=np.float64)[order]
+        self.q = counts / np.repeat(np.add.reduceat(counts, self.off), self.size)
+        self.accept, self.alias = self._build_alias()
+        self.start = contexts[helper.START]
+
+    def _build_alias(self):
+        """Vose's alias tables of every context.  Entry i is kept with
+        probability accept[i], or else replaced by entry alias[i]."""
+        accept = np.ones(len(self.q))
+        alias = np.arange(len(self.q))
+        for o, k in zip(self.off.tolist(), self.size.tolist()):
+            w = (self.q[o:o + k] * k).tolist()
+            small = [i for i in range(k) if w[i] < 1]
+            large = [i for i in range(k) if w[i] >= 1]
+            while small and large:
+                s, l = small.pop(), large[-1]
+                accept[o + s], alias[o + s] = w[s], o + l
+                w[l] -= 1 - w[s]
+                if w[l] < 1:
+                    small.append(large.pop())
+        return accept, alias
+
+    def sample(self, n, rng):
+        """Returns @n passwords sampled with the numpy Generator @rng, and
+        the probability of every one of them under the sampler.  A batch of
+        partial passwords is advanced one character at a time.
+        """
+        state = np.full(n, self.start, dtype=np.int64)
+        logq = np.zeros(n)
+        steps = []
+        alive = np.arange(n)
+        while len(alive):
+            h = state[alive]
+            u = rng.random(len(alive)) * self.size[h]
+            j = u.astype(np.int64)
+            pos = self.off[h] + j
+            pos = np.where(u - j < self.accept[pos], pos, self.alias[pos])
+            c = self.chars[pos]
+            logq[alive] += np.log(self.q[pos])
+            state[alive] = self.next[pos]
+            col = np.zeros(n, dtype=np.uint32)
+            col[alive] = c
+            steps.append(col)
+            alive = alive[c != ord(helper.END)]
+        # END and the padding are 0 in the matrix, which numpy strips from
+        # the ends of the (fixed width) strings
+        mat = np.stack(steps, axis=1)
+        mat[mat == ord(helper.END)] = 0
+        pws = mat.view('<U{}'.format(mat.shape[1])).ravel().tolist()
+        return pws, np.exp(logq)
+
+
+class NGramIndex(object):
+    """The counts of the n-grams of an NGramPw model (n <= MAX_PACKED_N) in
+    a sorted array of packed keys, so that the counts of many n-grams are
+    found with one np.searchsorted.  A key is packed with its first
+    character in the highest 16 bits, and 0 after its last character.
+    Keys with characters outside 1..0xFFFF are left out; the passwords with
+    such characters are not handled by the index.
+    @keys: the packed keys, sorted.
+    @counts: the count of every key.
+    """
+
+    def __init__(self, n, keys, counts):
+        self.n = n
+        self.keys = keys
+        self.counts = counts
+
+    @classmethod
+    def build(cls, T, n, reserved=()):
+        if n > MAX_PACKED_N:
+            raise ValueError("Keys are only packed for n <= {} (n={})"
+                             .format(MAX_PACKED_N, n))
+        keys, counts = [], []
+        for k, v in T.iteritems():
+            if len(k) <= n and k not in reserved:
+                keys.append(k)
+                counts.append(v)
+        mat = np.array(keys, dtype='<U{}'.format(n)).view(np.uint32) \
+            .reshape(len(keys), n)
+        ok = ((mat < 0x10000).all(axis=1) &
+              (np.array([len(k) for k in keys]) == (mat > 0).sum(axis=1)))
+        packed = cls._pack(mat[ok], n)
+        order = np.argsort(packed)
+        return cls(n, packed[order],
+                   np.array(counts, dtype=np.int64)[ok][order])
+
+    @staticmethod
+    def _pack(mat, n):
+        key = np.zeros(len(mat), dtype=np.uint64)
+        for t in range(mat.shape[1]):
+            key |= mat[:, t].astype(np.uint64) << np.uint64(16 * (n - 1 - t))
+        return key
+
+    def arrays(self):
+        """The arrays saved by models.save_npz, see load"""
+        return dict(n=self.n, keys=self.keys, counts=self.counts)
+
+    @classmethod
+    def load(cls, fname):
+        with np.load(fname) as d:
+            return cls(int(d['n']), d['keys'], d['counts'])
+
+    def lookup(self, keys):
+        """The counts of the packed @keys, 0 for the missing ones"""
+        i = np.searchsorted(self.keys, keys)
+        i[i == len(self.keys)] = 0
+        return np.where(self.keys[i] == keys, self.counts[i], 0)
+
+    def logprobs(self, pws, nchars):
+        """log of NGramPw.prob of the list of passwords @pws, with the add-1
+        smoothing over @nchars characters and the same backoff as
+        NGramPw.cprob; nan for the passwords that cannot be handled (a
+        character outside the index, or a character never seen in any
+        context).  Every character of every password is packed with its
+        history into one key, and the distinct keys are scored together.
+        """
+        n, V = self.n, nchars - 1
+        if len(pws) == 0:
+            return np.empty(0)
+        lens = np.fromiter(map(len, pws), dtype=np.int64, count=len(pws)) + 2
+        flat = np.frombuffer(
+            (helper.START + (helper.END + helper.START).join(pws) + helper.END)
+            .encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+        starts = np.cumsum(lens) - lens
+        row = np.repeat(np.arange(len(pws)), lens)
+        local = np.arange(len(flat)) - starts[row]
+        bad = np.zeros(len(pws), dtype=bool)
+        bad[row[(flat == 0) | (flat >= 0x10000)]] = True
+        # every character after START, packed after its history
+        pos = np.flatnonzero(local > 0)
+        hlen = np.minimum(local[pos], n - 1)
+        key = np.zeros(len(pos), dtype=np.uint64)
+        for t in range(n):
+            ch = flat[np.where(t <= hlen, pos - hlen + t, 0)]
+            key |= np.where(t <= hlen, ch, 0) << np.uint64(16 * (n - 1 - t))
+        key, inv = np.unique(key, return_inverse=True)
+        hlen = np.zeros(len(key), dtype=np.int64) - 1
+        for t in range(n):
+            hlen += (key >> np.uint64(16 * (n - 1 - t))) & np.uint64(0xFFFF) > 0
+        # the keys are sorted, and so are their histories (the key with its
+        # last character cleared), which keeps the binary searches in cache
+        mask = np.uint64((1 << (16 * n)) - 1) if n < 4 else \
+            np.uint64(0xFFFFFFFFFFFFFFFF)
+        d = np.zeros(len(key))
+        f = np.zeros(len(key))
+        todo = np.arange(len(key))
+        while len(todo):
+            k, l = key[todo], hlen[todo].astype(np.uint64)
+            last = np.uint64(0xFFFF) << (np.uint64(16) * (np.uint64(n - 1) - l))
+            dk = self.lookup(k & ~last)
+            d[todo], f[todo] = dk, self.lookup(k)
+            # back off to a shorter history where the count is 0
+            todo = todo[(dk == 0) & (hlen[todo] > 1)]
+            key[todo] = (key[todo] << np.uint64(16)) & mask
+            hlen[todo] -= 1
+        d, f = d[inv], f[inv]
+        bad[row[pos[d == 0]]] = True
+        logcp = np.log((f + 1) / (d + V))
+        # the characters of a password are contiguous in pos
+        logp = np.add.reduceat(logcp, np.cumsum(lens - 1) - (lens - 1))
+        logp[bad] = np.nan
+        return logp
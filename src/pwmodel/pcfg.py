@@ -0,0 +1,220 @@
+"""The grammar of a Weir PCFG model (PcfgPw), indexed for enumeration.
+
+The model DAWG holds the counts of
+  the base structures, e.g., '__S__L8D3__',
+  the nonterminals,     e.g., '__L8__', '__D3__',
+  the terminals,        e.g., 'password', '123',
+and the (topk) passwords themselves, as START + pw + END.
+PcfgGrammar reads them in one pass, and keeps the terminals of every
+nonterminal sorted once in decreasing order of their counts.  PcfgSampler
+draws passwords from the grammar in batches.
+"""
+
+import heapq
+import re
+
+import numpy as np
+
+from . import helper
+
+STRUCT_RE = re.compile(r'^__S__((?:[LDY][0-9]+)+)__$')
+NONT_RE = re.compile(r'^__([LDY][0-9]+)__$')
+# Maximum size of the queue of PcfgGrammar.iter_pws_in_order
+HEAP_SIZE = 1000000
+
+
+def nonterminal(tok):
+    """The nonterminal of the terminal @tok, e.g., '__L8__' for 'password'"""
+    return '__{0}{1}__'.format(helper.whatchar(tok), len(tok))
+
+
+class PcfgGrammar(object):
+    """@T: the DAWG of a PcfgPw model.
+    structures: [(base structure, its nonterminals)] with a nonzero count
+    freq[i]: the count of the i-th structure
+    base[i]: P[S] / prod(f(X) for the nonterminals X of the i-th structure)
+    terms[X]: (terminals, counts) of the nonterminal X, in decreasing order
+    of the counts (and then of the terminals).
+    The probability of a password is then base[i] * prod(f(terminal)), in
+    the same order of operations as PcfgPw.prob, so the values are equal.
+    """
+
+    def __init__(self, T):
+        structs, nonts, terms = {}, {}, {}
+        total = 0
+        for k, v in T.iteritems():
+            if not v or k.startswith(helper.START):
+                continue
+            if k.startswith('__S__'):   # as in PcfgPw.prob
+                total += v
+            m = STRUCT_RE.match(k)
+            if m:
+                structs[k] = (v, tuple('__{}__'.format(x) for x in
+                                       re.findall(r'[LDY][0-9]+', m.group(1))))
+                continue
+            m = NONT_RE.match(k)
+            if m:
+                nonts[k] = v
+                continue
+            terms.setdefault(nonterminal(k), []).append((-v, k))
+        self.total = float(total)
+        self.nonts = nonts
+        self.terms = {}
+        for X, l in terms.items():
+            l.sort()
+            self.terms[X] = ([t for _, t in l], [-v for v, _ in l])
+        self.structures, self.base, self.freq = [], [], []
+        for S, (v, X) in sorted(structs.items()):
+            if not all(x in self.terms and x in nonts for x in X):
+                continue
+            p = v / self.total
+            for x in X:
+                p /= nonts[x]
+            self.structures.append((S, X))
+            self.base.append(p)
+            self.freq.append(v)
+
+    def _prob(self, i, idx):
+        p = self.base[i]
+        for x, j in zip(self.structures[i][1], idx):
+            p *= self.terms[x][1][j]
+        return p
+
+    def _pw(self, i, idx):
+        return ''.join(self.terms[x][0][j]
+                       for x, j in zip(self.structures[i][1], idx))
+
+    def _canonical(self, i, pw):
+        """Whether @pw tokenizes back to the i-th structure.  The terminals
+        of a derivation can join into other tokens (e.g., 'phpbb' + '_' is
+        the single token 'phpbb_'); such a derivation is not the one scored
+        by PcfgPw.prob, and the password is yielded by its own."""
+        return helper.pcfg_tokens(pw)[0] == self.structures[i][0]
+
+    def _children(self, i, idx, pivot):
+        """The pre-terminals after (@i, @idx) in the "next" function of Weir
+        et al.: one index at or after @pivot is incremented.  Every index
+        vector has exactly one parent, so nothing is generated twice."""
+        X = self.structures[i][1]
+        for j in range(pivot, len(idx)):
+            if idx[j] + 1 < len(self.terms[X[j]][0]):
+                child = idx[:j] + (idx[j] + 1,) + idx[j + 1:]
+                yield self._prob(i, child), child, j
+
+    def iter_pws_in_order(self, heap_size=HEAP_SIZE):
+        """Yields (pw, prob) in non-increasing order of prob.  Only the
+        derivations that tokenize back to their own structure are yielded,
+        so every password comes out once, with prob equal to PcfgPw.prob.
+
+        The queue holds at most @heap_size pre-terminals.  When it is full,
+        its less probable half is dropped and the enumeration continues down
+        to the largest dropped probability (floor).  The next pass starts
+        again from the base structures, walks through the pre-terminals
+        above floor without yielding them, and yields the rest.
+        """
+        hi = float('inf')
+        while True:
+            heap, floor = [], 0.0
+
+            def push(p, i, idx, pivot):
+                nonlocal floor
+                if p <= floor:
+                    return
+                heapq.heappush(heap, (-p, i, idx, pivot))
+                if len(heap) > heap_size:
+                    heap.sort()   # a sorted list is still a heap
+                    cut = -heap[len(heap) // 2][0]
+                    if cut < hi:   # else they are all ties, keep them
+                        floor = max(floor, cut)
+                        del heap[len(heap) // 2:]
+
+            # the pre-terminals above hi were yielded in the earlier passes
+            stack = [(self._prob(i, (0,) * len(X)), i, (0,) * len(X), 0)
+                     for i, (S, X) in enumerate(self.structures)]
+            while stack:
+                p, i, idx, pivot = stack.pop()
+                if p > hi:
+                    stack.extend((q, i, c, j)
+                                 for q, c, j in self._children(i, idx, pivot))
+                else:
+                    push(p, i, idx, pivot)
+            while heap and -heap[0][0] > floor:
+                p, i, idx, pivot = heapq.heappop(heap)
+                pw = self._pw(i, idx)
+                if self._canonical(i, pw):
+                    yield pw, -p
+                for q, c, j in self._children(i, idx, pivot):
+                    push(q, i, c, j)
+            if floor == 0.0:
+                return
+            hi = floor
+
+
+class PcfgSampler(object):
+    """Cumulative tables for sampling passwords from a PcfgGrammar @G.  A
+    base structure is drawn with probability f(S) / sum_S' f(S') over the
+    structures of @G, and then every nonterminal X of it independently
+    rewritten to a terminal t with probability f(t) / sum_t' f(t') over the
+    terminals of X.
+    The terminals of all the nonterminals are stored in one flat array; the
+    terminals of the nonterminal x are at off[x]..off[x]+size[x], and cum is
+    the running sum of their counts over the whole array.
+    """
+
+    def __init__(self, G):
+        if not G.structures:
+            raise ValueError("The grammar has no base structure to sample")
+        nonts = sorted({x for _, X in G.structures for x in X})
+        xid = {x: i for i, x in enumerate(nonts)}
+        terms, counts = [], []
+        for x in nonts:
+            terms.extend(G.terms[x][0])
+            counts.extend(G.terms[x][1])
+        self.size = np.array([len(G.terms[x][0]) for x in nonts], dtype=np.int64)
+        self.off = np.cumsum(self.size) - self.size
+        counts = np.array(counts, dtype=np.float64)
+        self.cum = np.cumsum(counts)
+        self.xtot = np.add.reduceat(counts, self.off)
+        self.xstart = self.cum[self.off] - counts[self.off]
+        # the last entry is the empty string (with log probability 0), for
+        # the padding of short structures
+        self.logq_t = np.append(np.log(counts / np.repeat(self.xtot, self.size)),
+                                0.0)
+        self.terms = np.array(terms + [''], dtype=object)
+        maxlen = max(len(X) for _, X in G.structures)
+        self.X = np.full((len(G.structures), maxlen), -1, dtype=np.int64)
+        for i, (_, X) in enumerate(G.structures):
+            self.X[i, :len(X)] = [xid[x] for x in X]
+        freq = np.array(G.freq, dtype=np.float64)
+        self.scum = np.cumsum(freq)
+        self.logq_s = np.log(freq / self.scum[-1])
+
+    def sample(self, n, rng):
+        """Returns @n passwords sampled with the numpy Generator @rng, and
+        the probability of every one of them under the sampler.  All the
+        terminals of the batch are drawn with one binary search.
+        """
+        s = np.searchsorted(self.scum, rng.random(n) * self.scum[-1],
+                            side='right')
+        s = np.minimum(s, len(self.scum) - 1)
+        X = self.X[s]
+        used = X >= 0
+        x = X[used]
+        t = np.searchsorted(self.cum, self.xstart[x] + rng.random(len(x)) *
+                            self.xtot[x], side='right')
+        t = np.clip(t, self.off[x], self.off[x] + self.size[x] - 1)
+        idx = np.full(X.shape, len(self.terms) - 1, dtype=np.int64)
+        idx[used] = t
+        logq = self.logq_s[s] + self.logq_t[idx].sum(axis=1)
+        # the terminals are concatenated a column at a time, over the rows
+        # with at least that many nonterminals
+        nx = used.sum(axis=1)
+        order = np.argsort(-nx, kind='stable')
+        nalive = np.bincount(nx, minlength=X.shape[1] + 1)[::-1].cumsum()[::-1]
+        pws = self.terms[idx[order, 0]]
+        for j in range(1, X.shape[1]):
+            k = nalive[j + 1]
+            pws[:k] += self.terms[idx[order[:k], j]]
+        res = np.empty(n, dtype=object)
+        res[order] = pws
+        return res.tolist(), np.exp(logq)
@@ -0,0 +1,99 @@
+"""Frequency rank index of a histogram model (HistPw).
+
+The passwords of the model are stored in decreasing order of their counts,
+ties in sorted order of the passwords (the order of T.iteritems()), as one
+utf-8 byte string with the offset of every password:
+  freqs[r]                 the count of the password of rank r (0-based)
+  data[offs[r]:offs[r+1]]  the password of rank r
+So the password of a rank is a slice, and the rank of a password is a binary
+search over freqs for its tie group, and then over the (sorted) passwords of
+the group.
+"""
+
+import numpy as np
+
+
+class RankIndex(object):
+    """@freqs: counts in non-increasing order.
+    @offs: len(freqs)+1 offsets into @data.
+    @data: the utf-8 encoded passwords, in the order of @freqs.
+    """
+
+    def __init__(self, freqs, offs, data):
+        self.freqs = freqs
+        self.offs = offs
+        self.data = data
+        # ascending, for searchsorted
+        self._negfreqs = -freqs
+
+    @classmethod
+    def build(cls, T, reserved=()):
+        """Ranks the keys of @T, except those in @reserved"""
+        keys, freqs = [], []
+        for k, v in T.iteritems():
+            if k not in reserved:
+                keys.append(k.encode('utf-8'))
+                freqs.append(v)
+        freqs = np.array(freqs, dtype=np.int64)
+        order = np.argsort(-freqs, kind='stable')
+        lens = np.fromiter((len(keys[i]) for i in order), dtype=np.int64,
+                           count=len(keys))
+        offs = np.zeros(len(keys) + 1, dtype=np.int64)
+        np.cumsum(lens, out=offs[1:])
+        data = np.frombuffer(b''.join(keys[i] for i in order), dtype=np.uint8)
+        return cls(freqs[order], offs, data)
+
+    def arrays(self):
+        """The arrays saved by models.save_npz, see load"""
+        return dict(freqs=self.freqs, offs=self.offs, data=self.data)
+
+    @classmethod
+    def load(cls, fname):
+        with np.load(fname) as d:
+            return cls(d['freqs'], d['offs'], d['data'])
+
+    def __len__(self):
+        return len(self.freqs)
+
+    def _key(self, r):
+        return self.data[self.offs[r]:self.offs[r + 1]].tobytes()
+
+    def pw(self, r):
+        """(pw, count) of rank @r"""
+        if not -len(self) <= r < len(self):
+            raise IndexError("rank {} out of range [0, {})".format(r, len(self)))
+        r %= len(self)
+        return self._key(r).decode('utf-8'), int(self.freqs[r])
+
+    def range(self, a, b):
+        """[(pw, count)] of the ranks in [@a, @b)"""
+        a, b, _ = slice(a, b).indices(len(self))
+        if a >= b:
+            return []
+        s = self.data[self.offs[a]:self.offs[b]].tobytes()
+        offs = (self.offs[a:b + 1] - self.offs[a]).tolist()
+        return [(s[i:j].decode('utf-8'), f) for i, j, f in
+                zip(offs, offs[1:], self.freqs[a:b].tolist())]
+
+    def guess_numbers(self, freqs):
+        """1 + the number of passwords with a larger count than each of
+        @freqs; all the passwords with the same count get the same (the
+        best) guess number."""
+        return 1 + np.searchsorted(self._negfreqs,
+                                   -np.asarray(freqs, dtype=np.int64),
+                                   side='left')
+
+    def rank(self, pw, f):
+        """Rank of @pw, whose count is @f, or None if it is not ranked"""
+        lo = int(np.searchsorted(self._negfreqs, -f, side='left'))
+        hi = int(np.searchsorted(self._negfreqs, -f, side='right'))
+        key = pw.encode('utf-8')
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self) and self.freqs[lo] == f and self._key(lo) == key:
+            return lo
+        return None
@@ -1,8 +1,9 @@
 #!/usr/bin/env python3
 from __future__ import print_function
 import sys, os
-import bz2, re
+import bz2
 import itertools
+import json
 import operator
 import marisa_trie
 import numpy as np
@@ -11,7 +12,8 @@ from os.path import (expanduser)
 from math import sqrt
 # opens file checking whether it is bz2 compressed or not.
 import tarfile
-from .helper import open_get_line
+from .helper import open_get_line, tokens
+from .countfile import SpillCounter, last
 """A simple password library. Has function to put passwords into nice data
 structure for fast look up.
 
@@ -28,6 +30,13 @@ DEBUG = True
 home = expanduser("~")
 pass_dir = os.path.join(home, '.pypasswords')
 ROCKYOU_TOTAL_CNT = 32603388.0
+# Maximum number of distinct passwords counted in memory by
+# Passwords.create_data_structure before they are spilled to disk.
+MAX_DICT_SIZE = 10000000
+# Number of lines between two progress reports.
+PROGRESS_EVERY = 10000000
+# Number of passwords whose trie ids are looked up at once.
+ID_BATCH = 1 << 16
 
 def sample_following_dist(handle_iter, n, totalf):
     """Samples n passwords following the distribution from the handle
@@ -99,20 +108,10 @@ def is_asciistring(s):
         # warning("UnicodeError:", s, str(e))
         return False
 
-regex = r'([A-Za-z_]+)|([0-9]+)|(\W+)'
 def print_err( *args ):
     if DEBUG:
         sys.stderr.write(' '.join([str(a) for a in args])+'\n')
 
-def tokens(w):
-    T = []
-    while w:
-        m = re.match(regex, w)
-        T.append(m.group(0))
-        w = w[len(T[-1]):]
-    return T
-
-
 def whatchar(c):
     return 'L' if c.isalpha() else \
         'D' if c.isdigit else 'Y'
@@ -157,14 +156,9 @@ class Passwords(object):
     effect the totalf, and only changes the iterpws() function.
 
     @@kwargs: Add some extra arguments: @dirname='.' will use the local current
-    directory for effective data structures.  
-
-    WARNING: If your file contains more than 2MN, please create the trie from a
-    password frequency file using this command: 
-
-    $ pwfile=breach_compilation-withcount.txt;  awk '{$1=""; print $0}' ${pwfile} | marisa-build -o ${pwfile//.*}.trie
-
-    This will save significant amount of memory
+    directory for effective data structures.  @max_dict_size (default
+    MAX_DICT_SIZE) and @tmpdir bound the memory used to count the passwords
+    of large files, see create_data_structure.
     """
     def __init__(self, pass_file, min_pass_len=6, max_pass_len=50, **kwargs):
         self.fbasename = os.path.basename(pass_file).split('.', 1)[0]
@@ -180,11 +174,19 @@ class Passwords(object):
             _file_base_name += "N{}mn".format(int(_limit/1e6))
         print("Base file name: {}".format(_file_base_name))
         self._file_trie = _dirname / (_file_base_name + '.trie')
-        self._file_freq = _dirname / (_file_base_name + '.npz')
+        self._file_freq = _dirname / (_file_base_name + '.freq.npy')
+        self._file_fsum = _dirname / (_file_base_name + '.fsum.json')
+        # the compressed frequency file of the older versions
+        self._file_npz = _dirname / (_file_base_name + '.npz')
+        self._file_rank = _dirname / (_file_base_name + '.rank.npz')
+        self._file_cum = _dirname / (_file_base_name + '.cum.npy')
         self._T, self._freq_list, self._totalf = None, None, None
+        self._rank_freqs, self._rank_first = None, None
+        self._rank_negfreqs = None
+        self._cum = None
         if not kwargs.get('freshall', False) and \
            os.path.exists(self._file_trie) and \
-           os.path.exists(self._file_freq):
+           (os.path.exists(self._file_freq) or os.path.exists(self._file_npz)):
             self.load_data()
         else:
             if 'freshall' in kwargs: del kwargs['freshall']
@@ -193,56 +195,126 @@ class Passwords(object):
         self._sorted_freq_list = None
 
     def create_data_structure(self, pass_file, freshall=False, **kwargs):
-        # Record trie, Slow, and not memory efficient
-        # self._T = marisa_trie.RecordTrie(
-        #     '<II', ((unicode(w), (c,))
-        #             for i, (w,c) in
-        #     enumerate(passwords.open_get_line(pass_file)))
-        # )
+        """Reads @pass_file once, and builds the trie and the frequency
+        array from it.  The counts are kept in a SpillCounter, which writes
+        them to sorted runs under @tmpdir once it holds @max_dict_size
+        passwords, so the memory used for counting is bounded.  The trie is
+        then built from the merged runs in sorted order, and the frequencies
+        are filled by a second pass over the runs (not over @pass_file).
+        As before, a password that appears on several lines gets the count
+        of its last line.
+        """
         print(kwargs)
-        # If the trie for passwords is already there, read it
         print("Trie file: {}".format(self._file_trie))
-        if os.path.exists(self._file_trie) and not freshall:
-            self._T = marisa_trie.Trie()
-            self._T.load(self._file_trie)
-        else:
-            print("Recreating the trie file")
-            self._T = marisa_trie.Trie(w for w, c in open_get_line(pass_file, **kwargs))
-            self._T.save(self._file_trie)
-
-        self._freq_list = np.zeros(len(self._T), dtype=int)
-        for w, c in open_get_line(pass_file, **kwargs):
-            try:
-                self._freq_list[self._T.key_id(w)] = c
-            except Exception as e:
-                print("Error: {}. w={}, c={}".format(e, w, c))
-
-        self._totalf = self._freq_list.sum()
-        np.savez_compressed(
-            self._file_freq, freq=self._freq_list, fsum=self._totalf
-        )
-
-    def sample_pws(self, n, asperdist=True):
+        counts = SpillCounter(int(kwargs.get('max_dict_size', MAX_DICT_SIZE)),
+                              kwargs.get('tmpdir'))
+        try:
+            n = 0
+            for w, c in open_get_line(pass_file, **kwargs):
+                counts[w] = c
+                n += 1
+                if n % ID_BATCH == 0:
+                    counts.maybe_spill()
+                if n % PROGRESS_EVERY == 0:
+                    print("Read {} lines, {} passwords in memory"
+                          .format(n, len(counts)))
+            print("Read {} lines".format(n))
+            # If the trie for passwords is already there, read it
+            if os.path.exists(self._file_trie) and not freshall:
+                self._T = marisa_trie.Trie()
+                self._T.load(self._file_trie)
+            else:
+                print("Recreating the trie file")
+                self._T = marisa_trie.Trie(w for w, _ in counts.sorted_items(last))
+                # other processes may have the old trie mmapped
+                self._T.save(str(self._file_trie) + '.tmp')
+                os.replace(str(self._file_trie) + '.tmp', self._file_trie)
+
+            freq_list = np.zeros(len(self._T), dtype=np.int64)
+            get, items = self._T.get, counts.sorted_items(last)
+            while True:
+                batch = list(itertools.islice(items, ID_BATCH))
+                if not batch:
+                    break
+                ids = np.fromiter((get(w, -1) for w, _ in batch), dtype=np.int64,
+                                  count=len(batch))
+                f = np.array([c for _, c in batch])
+                # passwords missing from an existing trie are left out
+                freq_list[ids[ids >= 0]] = f[ids >= 0]
+        finally:
+            counts.close()
+
+        self.save_freq(freq_list)
+        self.load_data()
+
+    def cumfreq(self):
+        """The running sum of the frequencies, in the order of the ids.  It
+        is written once next to the frequency file (rebuilt if it is older)
+        and opened with mmap."""
+        if self._cum is not None:
+            return self._cum
+        if not os.path.exists(self._file_cum) or \
+           os.path.getmtime(self._file_cum) < os.path.getmtime(self._file_freq):
+            tmpf = str(self._file_cum) + '.tmp'
+            cum = np.lib.format.open_memmap(tmpf, mode='w+', dtype=np.int64,
+                                            shape=self._freq_list.shape)
+            np.cumsum(self._freq_list, dtype=np.int64, out=cum)
+            cum.flush()
+            del cum
+            os.replace(tmpf, self._file_cum)
+        self._cum = np.load(self._file_cum, mmap_mode='r')
+        return self._cum
+
+    def sample_pws(self, n, asperdist=True, seed=None):
         """Returns n passwords sampled from this password dataset.  if
         asperdist is True, then returns the password sampled according
         the password histogram distribution (with
         replacement). Passwords are always sampled with replacement.
+        Every sample is a binary search in cumfreq, so a call costs
+        O(n log N) and allocates nothing of the size of the dataset.
+        @seed: seed or numpy Generator, for reproducible samples.
 
         TODO: The sample users, instead of passwords perse.
         """
+        rng = np.random.default_rng(seed)
         if asperdist:
-            sample = np.random.choice(
-                self._freq_list.shape[0], size=n, p=self._freq_list/self._totalf
-            )
+            cum = self.cumfreq()
+            sample = np.searchsorted(cum, rng.integers(0, cum[-1], size=n),
+                                     side='right')
         else:
-            sample = np.random.choice(len(self._T), size=n)
-        return (self._T.restore_key(i) for i in sample)
+            sample = rng.integers(0, len(self._T), size=n)
+        return (self._T.restore_key(i) for i in sample.tolist())
+
+    def save_freq(self, freq_list):
+        """Writes the frequencies @freq_list as a raw .npy file, in the
+        smallest unsigned dtype that holds them, and their sum next to it.
+        Both files are written to a temporary file first, and renamed."""
+        totalf = int(freq_list.sum())
+        dtype = np.min_scalar_type(int(freq_list.max()) if len(freq_list) else 0)
+        with open(str(self._file_fsum) + '.tmp', 'w') as f:
+            json.dump({'fsum': totalf}, f)
+        with open(str(self._file_freq) + '.tmp', 'wb') as f:
+            np.save(f, freq_list.astype(dtype, copy=False))
+        os.replace(str(self._file_fsum) + '.tmp', self._file_fsum)
+        os.replace(str(self._file_freq) + '.tmp', self._file_freq)
 
     def load_data(self):
+        """Opens the trie and the frequencies with mmap, so the processes
+        that use the same files share one copy of them in the page cache.
+        A compressed .npz frequency file is converted first."""
+        if not os.path.exists(self._file_freq):
+            print("Converting {} to {}".format(self._file_npz, self._file_freq))
+            with np.load(self._file_npz) as np_f:
+                self.save_freq(np_f['freq'])
         self._T = marisa_trie.Trie()
-        self._T.load(self._file_trie)
-        np_f = np.load(self._file_freq)
-        self._freq_list, self._totalf = np_f['freq'], np_f['fsum']
+        self._T.mmap(str(self._file_trie))
+        self._freq_list = np.load(self._file_freq, mmap_mode='r')
+        with open(self._file_fsum) as f:
+            self._totalf = json.load(f)['fsum']
+        self._sorted_freq_list = None
+        self._rank_freqs, self._rank_first = None, None
+        self._rank_negfreqs = None
+        self._cum = None
 
     def totalf(self):
         return self._totalf
@@ -267,7 +339,7 @@ class Passwords(object):
 
     def pw2freq(self, pw):
         try:
-            return self._freq_list[self._T.key_id(pw)]
+            return int(self._freq_list[self._T.key_id(pw)])
             # return self._T.get(unicode(pw), 0)
         except KeyError:
             return 0
@@ -275,7 +347,7 @@ class Passwords(object):
     def id2freq(self, _id):
         _id = int(_id)
         try:
-            return self._freq_list[_id]
+            return int(self._freq_list[_id])
         except ValueError:
             return 0
 
@@ -285,7 +357,9 @@ class Passwords(object):
         if q == 0:
             return self._totalf
         else:
-            return -np.partition(-self._freq_list, q)[:q].sum()
+            # the frequencies are unsigned, so they are not negated
+            n = len(self._freq_list)
+            return int(np.partition(self._freq_list, n - q)[n - q:].sum())
 
     def iterpws(self, n):
         """
@@ -300,11 +374,11 @@ class Passwords(object):
         for _id in self._sorted_freq_list:
             pw = self._T.restore_key(_id)
             if self._min_pass_len <= len(pw) <= self._max_pass_len:
-                yield _id, pw, self._freq_list[_id]
+                yield _id, pw, int(self._freq_list[_id])
 
     def justiter(self):
         for w, _id in self._T.iteritems():
-            yield _id, w, self._freq_list[_id]
+            yield _id, w, int(self._freq_list[_id])
 
     def keys(self):
         return self._T.iterkeys()
@@ -312,14 +386,49 @@ class Passwords(object):
     def values(self):
         return self._freq_list
 
+    def pws2freqs(self, pws):
+        """Frequencies of the passwords in @pws (any iterable), as a numpy
+        array; 0 for the passwords not in the file"""
+        get = self._T.get
+        ids = np.fromiter((get(pw, -1) for pw in pws), dtype=np.int64)
+        return np.where(ids >= 0, self._freq_list[ids], 0).astype(np.int64)
+
+    def rank_table(self):
+        """The distinct frequencies of the passwords in decreasing order,
+        and the guess rank of each of them, i.e., 1 + the number of
+        passwords with a larger frequency.  All the passwords with the same
+        frequency share the same (the best) guess rank.  The table is saved
+        next to the frequency file, and rebuilt if it is older.
+        """
+        if self._rank_freqs is not None:
+            return self._rank_freqs, self._rank_first
+        if os.path.exists(self._file_rank) and \
+           os.path.getmtime(self._file_rank) >= os.path.getmtime(self._file_freq):
+            with np.load(self._file_rank) as d:
+                self._rank_freqs, self._rank_first = d['freqs'], d['ranks']
+        else:
+            freqs, counts = np.unique(self._freq_list, return_counts=True)
+            freqs, counts = freqs[::-1].astype(np.int64), counts[::-1]
+            ranks = np.cumsum(counts) - counts + 1
+            with open(str(self._file_rank) + '.tmp', 'wb') as f:
+                np.savez(f, freqs=freqs, ranks=ranks)
+            os.replace(str(self._file_rank) + '.tmp', self._file_rank)
+            self._rank_freqs, self._rank_first = freqs, ranks
+        # ascending, for searchsorted in guessranks
+        self._rank_negfreqs = -self._rank_freqs
+        return self._rank_freqs, self._rank_first
+
     def guessranks(self, pws):
         """return teh guess rank of a password @pw according to this 
-        password distribution file"""
-        # if self._sorted_freq_list is None:
-        #     self._sorted_freq_list = np.argsort(self._freq_list)[::-1]
-        freqs = np.array([self.pw2freq(pw) for pw in pws]).reshape(-1, 1)
-        ranks = (np.tile(self._freq_list, freqs.shape) > freqs).sum(axis=1) + 1
-        return ranks
+        password distribution file, i.e., 1 + the number of passwords that
+        are more frequent.  Each rank is a binary search in rank_table.
+        """
+        freqs, ranks = self.rank_table()
+        f = self.pws2freqs(pws)
+        # number of distinct frequencies larger than f
+        i = np.searchsorted(self._rank_negfreqs, -f, side='left')
+        return np.where(i < len(freqs), ranks[np.minimum(i, len(freqs) - 1)],
+                        len(self._freq_list) + 1)
 
     def __iter__(self):
         """Returns the id and frequency of the passwords, you can get
@@ -327,13 +436,15 @@ class Passwords(object):
         if self._sorted_freq_list is None:
             self._sorted_freq_list = np.argsort(self._freq_list)[::-1]
         for _id in self._sorted_freq_list:
-            yield _id, self._freq_list[_id]
+            yield _id, int(self._freq_list[_id])
 
     def __getitem__(self, k):
+        # the frequencies are stored in a compact unsigned dtype, which
+        # would wrap around in arithmetic; they are returned as int
         if isinstance(k, int):
-            return self._freq_list[k]
+            return int(self._freq_list[k])
         if isinstance(k, str):
-            return self._freq_list[self.pw2id(k)]
+            return int(self._freq_list[self.pw2id(k)])
         raise TypeError("_id is wrong type ({}) expects str or int"
                         .format(type(k)))
 
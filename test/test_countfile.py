@@ -0,0 +1,39 @@
+from collections import Counter
+
+from .context import pwmodel
+from pwmodel import countfile
+
+
+def test_write_read_counts(tmp_path):
+    fname = str(tmp_path / 'a.cnt.gz')
+    items = [('\x02pa', 3), ('abc', 1), ('pass\tword', 2), ('été', 5)]
+    assert countfile.write_counts(fname, items, header={'npws': 4}) == 4
+    assert countfile.read_header(fname) == {'npws': 4}
+    assert list(countfile.iter_counts(fname)) == items
+
+
+def test_merge_count_files(tmp_path):
+    total = Counter()
+    fnames = []
+    for i in range(10):
+        c = Counter({'k{}'.format(j): i + j for j in range(i, i + 20)})
+        total.update(c)
+        fnames.append(str(tmp_path / '{}.cnt.gz'.format(i)))
+        countfile.write_counts(fnames[-1], sorted(c.items()))
+    merged = list(countfile.merge_count_files(fnames, tmpdir=str(tmp_path),
+                                              fan_in=3))
+    assert merged == sorted(total.items())
+
+
+def test_merge_count_files_last(tmp_path):
+    latest = {}
+    fnames = []
+    for i in range(10):
+        c = {'k{}'.format(j): i + j for j in range(i, i + 20)}
+        latest.update(c)
+        fnames.append(str(tmp_path / '{}.cnt.gz'.format(i)))
+        countfile.write_counts(fnames[-1], sorted(c.items()))
+    merged = list(countfile.merge_count_files(fnames, tmpdir=str(tmp_path),
+                                              fan_in=3,
+                                              combine=countfile.last))
+    assert merged == sorted(latest.items())
@@ -75,3 +75,15 @@ class TestPCFG(object):
         for pw1, pw2 in [('password12', 'assword1'),
                          ('abcd123', 'abcd1234')]:
             assert pcfgpw.prob(pw1) > pcfgpw.prob(pw2)
+
+    @pytest.mark.parametrize(
+        'word',
+        ['', 'password', 'a_b', '__', '_1_', 'ab  cd!!12', 'x' * 100 + '1' * 70,
+         'a_' * 40, '!' * 70])
+    def test_tokens_compiled(self, word, pcfgpw):
+        assert pwm.helper.tokens(word) == pwm.helper._tokens(word)
+        assert pwm.helper.pcfg_tokens(word) == pwm.helper._pcfg_tokens(word)
+        assert pwm.helper.pcfg_tokens_many([word, word]) == \
+            [pwm.helper._pcfg_tokens(word)] * 2
+        if word:
+            assert ''.join(pwm.helper.tokens(word)) == word
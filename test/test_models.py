@@ -1,5 +1,9 @@
+import itertools
 import os
 
+import dawg
+import numpy as np
+import pytest
 from .context import pwmodel as pwm
 
 leak_file = os.path.join(pwm.helper.thisdir, 'data', 'phpbb-withcount.txt.gz')
@@ -43,6 +47,37 @@ def test_qth_pw():
     assert all(x[1] >= y[1] for x, y in zip(L, L[1:]))
 
 
+def test_hist_rank_index():
+    hm = pwm.HistPw(leak_file)
+    top = hm.top(300)
+    assert top[0] == ('123456', hm._T['123456'])
+    assert [hm.qth_pw(q) for q in range(300)] == top
+    assert hm.rank_range(100, 120) == top[100:120]
+    # ties are in sorted order of the passwords
+    assert all(x[1] > y[1] or (x[1] == y[1] and x[0] < y[0])
+               for x, y in zip(top, top[1:]))
+    n = len(hm.rank_index())
+    for q in [0, 1, 17, 299, n // 2, n - 1]:
+        pw, f = hm.qth_pw(q)
+        assert hm.rank_of(pw) == q and hm._T[pw] == f
+    assert hm.rank_of('not a password in the leak') is None
+    with pytest.raises(IndexError):
+        hm.qth_pw(n)
+
+
+def test_hist_rank_index_of_given_T():
+    # a model built from T= must not read the sidecar of the model file at
+    # its default path
+    tmp = pwm.HistPw('', leak='tmp', listw=[('alpha', 5), ('beta', 3)])
+    assert tmp.qth_pw(0) == ('alpha', 5)
+    T = dawg.IntCompletionDAWG([('zeta', 7), ('eta', 2),
+                                (pwm.models.TOTALF_W, 9),
+                                (pwm.models.NPWS_W, 2)])
+    hm = pwm.HistPw('', T=T)
+    assert hm.top(2) == [('zeta', 7), ('eta', 2)]
+    assert hm.rank_of('zeta') == 0
+
+
 def test_cmp_ngram():
     """
     Test three models and order them
@@ -67,3 +102,342 @@ def test_cmp_ngram():
     print(',\t\t'.join(m.modelname for m in models))
     for pws in zip(*pwlist):
         print(',\t\t'.join(pws))
+
+
+def test_create_model_workers(tmp_path):
+    ngpw = pwm.NGramPw(n=3, leak='tmp', listw=[('password', 1)])
+    kwargs = dict(fname=leak_file, limit=20000, topk=100,
+                  modelfunc=ngpw.ngramsofw)
+    serial = pwm.models.create_model(
+        outfname=str(tmp_path / 'serial.dawg.gz'), **kwargs)
+    parallel = pwm.models.create_model(
+        outfname=str(tmp_path / 'parallel.dawg.gz'), workers=2,
+        chunksize=3000, **kwargs)
+    assert serial.items() == parallel.items()
+    assert parallel[pwm.models.NPWS_W] == serial[pwm.models.NPWS_W]
+    assert parallel[pwm.models.TOTALF_W] == serial[pwm.models.TOTALF_W]
+
+
+def test_create_model_spill(tmp_path):
+    hm = pwm.HistPw(leak_file)
+    kwargs = dict(fname=leak_file, limit=20000, topk=100, modelfunc=hm.modelfunc)
+    inmem = pwm.models.create_model(
+        outfname=str(tmp_path / 'inmem.dawg.gz'), **kwargs)
+    spilled = pwm.models.create_model(
+        outfname=str(tmp_path / 'spilled.dawg.gz'), max_dict_size=1000,
+        tmpdir=str(tmp_path), **kwargs)
+    assert inmem.items() == spilled.items()
+    assert list(tmp_path.glob('pwcf-*')) == []
+
+
+def test_update():
+    pws = list(pwm.helper.open_get_line(leak_file, limit=2000))
+    old, new = pws[:1500], pws[1500:]
+    for cls in [pwm.HistPw, pwm.NGramPw, pwm.PcfgPw]:
+        full = cls('', leak='tmp', listw=pws)
+        m = cls('', leak='tmp', listw=old)
+        m.update(listw=new)
+        assert m._T.items() == full._T.items()
+        assert m.npws() == full.npws() and m.totalf() == full.totalf()
+        assert m.prob('password') == full.prob('password')
+        assert m._T.items() == pwm.models.read_dawg(m._modelf).items()
+
+
+def test_merge_models(tmp_path):
+    pws = list(pwm.helper.open_get_line(leak_file, limit=3000))
+    for cls, name in [(pwm.HistPw, 'histogram'), (pwm.NGramPw, 'ngram-3'),
+                      (pwm.PcfgPw, 'weir-pcfg')]:
+        full = cls('', leak='tmp', listw=pws)
+        fnames = []
+        for i in range(3):
+            fnames.append(str(tmp_path / '{}-{}.cnt.gz'.format(name, i)))
+            pwm.create_partial(name, listw=pws[i::3], outfname=fnames[-1])
+        m = pwm.merge_models(fnames, outfname=str(tmp_path / 'merged.dawg.gz'))
+        assert isinstance(m, cls)
+        assert m._T.items() == full._T.items()
+        assert m.prob('password') == full.prob('password')
+
+
+def test_create_partial_reads_whole_file(tmp_path, monkeypatch):
+    # count_model's own limit (3e6 lines) must not cut a shard short
+    count_model, seen = pwm.models.count_model, {}
+
+    def spy(*args, **kwargs):
+        seen.update(kwargs)
+        return count_model(*args, **kwargs)
+    monkeypatch.setattr(pwm.models, 'count_model', spy)
+    pwm.create_partial('histogram', listw=[('a', 1)],
+                       outfname=str(tmp_path / 'h.cnt.gz'))
+    assert seen['limit'] == -1
+
+
+def test_mmap_model():
+    pws = list(pwm.helper.open_get_line(leak_file, limit=3000))
+    for cls in [pwm.HistPw, pwm.NGramPw, pwm.PcfgPw]:
+        m = cls('', leak='tmp', listw=pws, mmap=True)
+        assert m._modelf.endswith('.trie')
+        assert isinstance(m._T, pwm.models.MmapDAWG)
+        full = cls('', leak='tmp', listw=pws)
+        assert m._T.items() == full._T.items()
+        assert m._T.items('pass') == full._T.items('pass')
+        assert m._T.prefixes('passwo') == full._T.prefixes('passwo')
+        for pw in ['password', '123456', 'asd;lfkjasdfj']:
+            assert m.prob(pw) == full.prob(pw)
+        m.update(listw=pws[:10])
+        assert isinstance(m._T, pwm.models.MmapDAWG)
+        assert m.npws() > full.npws()
+
+
+def test_mmap_generations(tmp_path):
+    MmapDAWG = pwm.models.MmapDAWG
+    fname = str(tmp_path / 'm.trie')
+    MmapDAWG.save([('a', 1), ('b', 2)], fname)
+    first = MmapDAWG(fname)
+    MmapDAWG.save([('a', 10), ('c', 30)], fname)
+    # one link and the three files of the current generation
+    assert os.path.islink(fname) and len(os.listdir(str(tmp_path))) == 4
+    assert first.items() == [('a', 1), ('b', 2)]
+    assert MmapDAWG(fname).items() == [('a', 10), ('c', 30)]
+    # the plain files of the older layout are still read, and replaced
+    legacy = str(tmp_path / 'old.trie')
+    gen = os.path.realpath(fname)
+    for ext in ['.trie', '.counts.npy', '.order.npy']:
+        os.rename(gen[:-len('.trie')] + ext, legacy[:-len('.trie')] + ext)
+    assert MmapDAWG(legacy).items() == [('a', 10), ('c', 30)]
+    MmapDAWG.save([('d', 4)], legacy)
+    assert MmapDAWG(legacy).items() == [('d', 4)]
+    assert not os.path.exists(str(tmp_path / 'old.counts.npy'))
+    # remove deletes the link and every generation, also those orphaned by
+    # removing only the link, but not the files of other models
+    os.remove(legacy)
+    MmapDAWG.save([('e', 5)], legacy)
+    MmapDAWG.save([('f', 6)], str(tmp_path / 'old.ctx.trie'))
+    MmapDAWG.remove(legacy)
+    assert not any(f.startswith('old.') and not f.startswith('old.ctx.')
+                   for f in os.listdir(str(tmp_path)))
+    assert MmapDAWG(str(tmp_path / 'old.ctx.trie')).items() == [('f', 6)]
+
+
+def test_prob_many():
+    pws = [pw for pw, _ in pwm.helper.open_get_line(leak_file, limit=500)]
+    pws += ['password', 'p', 'asdf;lkj8', pws[3]]
+    for m in [pwm.NGramPw(leak_file, n=4), pwm.PcfgPw(leak_file),
+              pwm.HistPw(leak_file)]:
+        probs = m.prob_many(iter(pws))
+        assert probs.shape == (len(pws),)
+        for pw, p in zip(pws, probs):
+            assert p == pytest.approx(m.prob(pw), rel=1e-9, abs=0)
+        assert len(m.prob_many([])) == 0
+
+
+@pytest.mark.parametrize('n', [2, 3, 4])
+def test_ngram_index(n):
+    m = pwm.NGramPw(leak_file, n=n)
+    pws = [pw for pw, _ in pwm.helper.open_get_line(leak_file, limit=300)]
+    pws += ['password', 'x', '', 'moo cow', 'q' * 30, '\x02\x02']
+    logp = m.ngram_index().logprobs(pws, pwm.models.N_VALID_CHARS)
+    for pw, lp in zip(pws, logp):
+        assert np.exp(lp) == pytest.approx(m.prob(pw), rel=1e-9, abs=0)
+    assert os.path.exists(pwm.models.sidecar_path(m._modelf, 'ngrams', '.npz'))
+    keys = m.ngram_index().keys
+    m._reset_caches()
+    assert m._index is None
+    assert np.array_equal(m.ngram_index().keys, keys)
+    # characters outside the index are left to prob
+    assert np.isnan(m.ngram_index().logprobs(['x\U0001F600'], 96)[0])
+    with pytest.raises(AssertionError):
+        m.prob_many(['x\U0001F600'])
+
+
+def test_ngram_context_table():
+    m = pwm.NGramPw(leak_file, n=3)
+    assert os.path.exists(pwm.models.sidecar_path(m._modelf, 'ctx'))
+    for h in ['', 'a', 'pa', 'as', '12', pwm.helper.START, 'q$', 'zz']:
+        scan = float(sum(v for _, v in m._T.iteritems(h)))
+        assert m.sum_freq(h) == scan
+    for h in ['\x02pas', 'passw', '123', '\x02', 'qz']:
+        d = m._get_next(h)
+        assert d and all(p > 0 for p in d.values())
+    assert m._get_next('\x02pas') is m._get_next('xpas')
+    for h in ['\x02', 'pa', 'a', '3', '\x02z']:
+        tot = m._T[h] + pwm.models.N_VALID_CHARS - 1
+        scan = {k[-1]: (v + 1) / tot for k, v in m._T.iteritems(h)
+                if len(k) == len(h) + 1}
+        assert m._next_dist(h) == pytest.approx(scan, rel=1e-12)
+        assert m._successors(h) == sorted(scan.items(), key=lambda x: -x[1])
+
+
+@pytest.mark.parametrize('n', [2, 3, 4])
+def test_ngram_dense(n):
+    m, d = pwm.NGramPw(leak_file, n=n), pwm.NGramPw(leak_file, n=n, dense=True)
+    pws = [pw for pw, _ in pwm.helper.open_get_line(leak_file, limit=300)]
+    pws += ['password', 'x', '', 'moo cow', 'q' * 30]
+    for pw in pws:
+        assert d.prob(pw) == pytest.approx(m.prob(pw), rel=1e-12, abs=0)
+    assert d.prob_many(pws) == pytest.approx(m.prob_many(pws), rel=1e-9, abs=0)
+    for h in [pwm.helper.START, '\x02pas', 'ssw']:
+        dist = d._get_next(h)
+        assert dist and all(d.cprob(c, h) == pytest.approx(p, rel=1e-12)
+                            for c, p in dist.items())
+    assert all(pw.isprintable() for pw in (d.sample_pw() for _ in range(20)))
+
+
+def test_ngram_dense_kernel():
+    d = pwm.NGramPw(leak_file, n=3, dense=True)._dense
+    pws = [pw for pw, _ in pwm.helper.open_get_line(leak_file, limit=300)]
+    pws += ['', 'moo cow', 'x€x']
+    ids, lens = d._encode_many(pws)
+    out = np.empty(len(pws))
+    pwm._fast.ngram_logprobs(d.P, d.next, ids, lens, d.start, out)
+    assert np.isnan(out[-1]) and np.isnan(d._logprobs(ids, lens)[-1])
+    assert out[:-1] == pytest.approx(d._logprobs(ids, lens)[:-1], rel=1e-12)
+
+
+def test_ngram_sample_pws():
+    m = pwm.NGramPw(leak_file, n=3)
+    pws, q = m.sample_pws(5000, seed=7, return_probs=True)
+    assert len(pws) == 5000 and q.shape == (5000,)
+    assert pws == m.sample_pws(5000, seed=7)
+    assert pws != m.sample_pws(5000, seed=8)
+    for pw, p in list(zip(pws, q))[:50]:
+        s = pwm.helper.START + pw + pwm.helper.END
+        expected = 1.0
+        for i in range(1, len(s)):
+            h = s[max(0, i - 2):i]
+            expected *= m._T[h + s[i]] / m._T[h]
+        assert p == pytest.approx(expected, rel=1e-9)
+
+
+def test_ngram_iter_pws_in_order(tmpdir):
+    m = pwm.NGramPw(leak_file, n=3)
+    full = list(itertools.islice(m.iter_pws_in_order(band_size=500), 3000))
+    probs = [p for _, p in full]
+    assert probs == sorted(probs, reverse=True)
+    assert len(set(pw for pw, _ in full)) == len(full)
+    assert all(p == m.prob(pw) for pw, p in full[::37])
+    # stop half way, and resume from the checkpoint
+    ckpt = str(tmpdir.join('ckpt.json'))
+    it = m.iter_pws_in_order(band_size=500, checkpoint=ckpt)
+    first = list(itertools.islice(it, 1234))
+    it.close()
+    rest = itertools.islice(m.iter_pws_in_order(band_size=500, checkpoint=ckpt),
+                            3000 - 1234)
+    assert first + list(rest) == full
+    assert m.generate_pws_in_order(100) == full[:100]
+
+
+def test_ngram_write_pws_in_order(tmpdir):
+    m = pwm.NGramPw(leak_file, n=3)
+    expected = m.generate_pws_in_order(2500)
+    fnames = m.write_pws_in_order(str(tmpdir), 2500, chunk_size=1000,
+                                  workers=2, band_size=500)
+    assert [os.path.basename(f) for f in fnames] == \
+        ['guesses-000000.txt', 'guesses-000001.txt', 'guesses-000002.txt']
+    got = []
+    for f in fnames:
+        with open(f) as fin:
+            got.extend((pw, float(p)) for pw, p in
+                       (l.rstrip('\n').split('\t') for l in fin))
+    assert got == expected
+
+    # crash in the middle of the second chunk, and resume
+    outdir, ckpt = str(tmpdir.join('ckpt')), str(tmpdir.join('ckpt.json'))
+    seen = []
+
+    def crash(pw):
+        seen.append(pw)
+        if len(seen) == 1500:
+            raise KeyboardInterrupt
+        return True
+    with pytest.raises(KeyboardInterrupt):
+        m.write_pws_in_order(outdir, 2500, chunk_size=1000, checkpoint=ckpt,
+                             band_size=500, filter_func=crash)
+    assert sorted(os.listdir(outdir)) == ['guesses-000000.txt']
+    fnames = m.write_pws_in_order(outdir, 2500, chunk_size=1000,
+                                  checkpoint=ckpt, band_size=500)
+    assert len(fnames) == 3
+    got = []
+    for f in fnames:
+        with open(f) as fin:
+            got.extend((pw, float(p)) for pw, p in
+                       (l.rstrip('\n').split('\t') for l in fin))
+    assert got == expected
+    # nothing left to write
+    assert m.write_pws_in_order(outdir, 2500, chunk_size=1000,
+                                checkpoint=ckpt, band_size=500) == fnames
+
+
+def test_ngram_guess_number():
+    m = pwm.NGramPw(leak_file, n=3)
+    ordered = m.generate_pws_in_order(3000)
+    g = m.guess_numbers([pw for pw, _ in ordered], n=20000, seed=3)
+    assert g[0] == 1 and all(np.diff(g) >= 0)
+    for i in [300, 1000, 2999]:
+        assert g[i] == pytest.approx(i + 1, rel=0.2)
+    fname = pwm.models.sidecar_path(m._modelf, 'mc-20000-3', '.npz')
+    assert os.path.exists(fname)
+    m._estimators.clear()
+    assert m.guess_number(ordered[1000][0], n=20000, seed=3) == g[1000]
+    # a model built from T= has no model file to keep the samples next to
+    t = pwm.NGramPw(T=m._T, n=3)
+    fname = pwm.models.sidecar_path(t._modelf, 'mc-2000-3', '.npz')
+    if os.path.exists(fname):
+        os.remove(fname)
+    t.guess_numbers(['password'], n=2000, seed=3)
+    assert not os.path.exists(fname)
+    hm = pwm.HistPw(leak_file)
+    assert hm.guess_number('123456') == 1
+    top = hm.top(200)
+    for pw, f in top[::7]:
+        assert hm.guess_number(pw) == 1 + sum(f1 > f for _, f1 in top)
+    # ties share the best guess number
+    same = [pw for pw, f in top if f == top[-1][1]]
+    assert len(set(hm.guess_numbers(same).tolist())) == 1
+    assert hm.guess_number('not a password in the leak') == \
+        len(hm.rank_index()) + 1
+
+
+def test_pcfg_generate_in_order():
+    m = pwm.PcfgPw(leak_file)
+    pws = m.generate_pws_in_order(5000)
+    assert pws[0][0] == '123456'
+    probs = [p for _, p in pws]
+    assert probs == sorted(probs, reverse=True)
+    assert len(set(pw for pw, _ in pws)) == len(pws)
+    assert all(p == m.prob(pw) for pw, p in pws[::17])
+    # a small queue needs several passes, but gives the same stream
+    assert list(itertools.islice(m.iter_pws_in_order(heap_size=100), 5000)) == pws
+    # 'phpbb' + '_' joins into the single token 'phpbb_', which must only
+    # come out of its own structure
+    pws = m.generate_pws_in_order(20000)
+    underscored = [(pw, p) for pw, p in pws if '_' in pw]
+    assert [pw for pw, _ in underscored].count('phpbb_') == 1
+    assert all(p == m.prob(pw) for pw, p in underscored)
+    assert len(set(pw for pw, _ in pws)) == len(pws)
+
+
+def test_pcfg_prob_index():
+    m = pwm.PcfgPw(leak_file)
+    T = m._T
+    total = sum(v for _, v in T.items('__S__'))
+    for pw in ['password', 'password@123', 'Abc!!99x', 'zzzz9999zzzz']:
+        toks = m.pcfgtokensofw(pw)
+        k = (len(toks) - 1) // 2
+        expected = T.get(toks[0], 0) / total
+        for nt, t in zip(toks[1:k + 1], toks[k + 1:]):
+            expected *= T.get(t, 0) / T[nt]
+        assert m.prob(pw) == pytest.approx(expected, rel=1e-12)
+    assert m.tokprob('password', '__L8__') == T['password'] / T['__L8__']
+
+
+def test_pcfg_sample_pws():
+    m = pwm.PcfgPw(leak_file)
+    pws, q = m.sample_pws(20000, seed=7, return_probs=True)
+    assert len(pws) == 20000 and q.shape == (20000,)
+    assert pws == m.sample_pws(20000, seed=7)
+    assert pws != m.sample_pws(20000, seed=8)
+    p = m.prob_many(pws)
+    assert np.isclose(q, p, rtol=1e-9).mean() > 0.99
+    # the most probable password is sampled about as often as it should be
+    top, ptop = m.generate_pws_in_order(1)[0]
+    assert pws.count(top) == pytest.approx(20000 * ptop, rel=0.3)
@@ -5,6 +5,7 @@ import os
 from .context import phpbb_leak_file, test_file
 import io
 import tempfile
+import numpy as np
 
 class TestPasswords(unittest.TestCase):
     def test_pw2freq(self):
@@ -38,6 +39,56 @@ class TestPasswords(unittest.TestCase):
                              .format(pw, f, pws.pw2freq(pw)))
 
 
+    def test_create_spilled(self):
+        with tempfile.TemporaryDirectory() as d:
+            pws = Passwords(phpbb_leak_file, dirname=d, freshall=True,
+                            limit=20000, max_dict_size=3000, tmpdir=d)
+            counts = {}
+            for w, c in helper.open_get_line(phpbb_leak_file, limit=20000):
+                counts[w] = c
+            self.assertEqual(len(pws), len(counts))
+            self.assertEqual(pws.totalf(), sum(counts.values()))
+            for w, c in list(counts.items())[::97]:
+                self.assertEqual(pws.pw2freq(w), c)
+
+    def test_mmap_compact_freq(self):
+        with tempfile.TemporaryDirectory() as d:
+            pws = Passwords(phpbb_leak_file, dirname=d, freshall=True,
+                            limit=20000)
+            pws1 = Passwords(phpbb_leak_file, dirname=d, limit=20000)
+            self.assertIsInstance(pws1._freq_list, np.memmap)
+            self.assertEqual(pws1._freq_list.dtype, np.uint16)
+            self.assertEqual(pws1.totalf(), pws.totalf())
+            # the public accessors return int, not the compact dtype
+            top = pws1.pw2freq('123456')
+            self.assertIs(type(top), int)
+            self.assertIs(type(pws1['123456']), int)
+            self.assertIs(type(next(pws1.iterpws(1))[2]), int)
+            self.assertIs(type(pws1.id2freq(pws1.pw2id('123456'))), int)
+            self.assertEqual(top + 65535, pws.pw2freq('123456') + 65535)
+            self.assertEqual(pws1.sumvalues(5),
+                             np.sort(pws1._freq_list.astype(int))[-5:].sum())
+            # the compressed files of the older versions are converted
+            np.savez_compressed(pws._file_npz, freq=pws1._freq_list.astype(int),
+                                fsum=pws1.totalf())
+            os.remove(pws._file_freq)
+            pws2 = Passwords(phpbb_leak_file, dirname=d, limit=20000)
+            self.assertTrue(os.path.exists(pws._file_freq))
+            self.assertEqual(pws2.pw2freq('123456'), pws.pw2freq('123456'))
+
+    def test_sample_pws(self):
+        pwm = Passwords(phpbb_leak_file)
+        pws = list(pwm.sample_pws(20000, seed=5))
+        self.assertEqual(pws, list(pwm.sample_pws(
+            20000, seed=np.random.default_rng(5))))
+        self.assertNotEqual(pws, list(pwm.sample_pws(20000, seed=6)))
+        self.assertTrue(all(pwm.pw2freq(pw) > 0 for pw in pws[:500]))
+        self.assertAlmostEqual(pws.count('123456') / 20000.,
+                               pwm.prob('123456'), delta=0.003)
+        self.assertTrue(os.path.exists(pwm._file_cum))
+        self.assertEqual(pwm.cumfreq()[-1], pwm.totalf())
+        self.assertEqual(len(list(pwm.sample_pws(7, asperdist=False))), 7)
+
     def test_getranks(self):
         pwm = Passwords(test_file, sep='\t', freshall=True)
         pws =  [('password', 1), ('asdfaafdsf', 4)]
@@ -48,8 +99,97 @@ class TestPasswords(unittest.TestCase):
                              "{!r}, expected {}, got {}"\
                              .format(pw, r, t))
 
+    def test_guessranks_ties(self):
+        pwm = Passwords(phpbb_leak_file)
+        f = pwm._freq_list
+        pws = ['123456', 'password', 'michelle', 'familia', 'asdfasdf2wg']
+        expected = [(f > pwm.pw2freq(pw)).sum() + 1 for pw in pws]
+        self.assertEqual(pwm.guessranks(pws).tolist(), expected)
+        # passwords with the same frequency get the same rank
+        self.assertEqual(pwm.pw2freq('familia'), pwm.pw2freq('honeybunny'))
+        r = pwm.guessranks(['familia', 'honeybunny'])
+        self.assertEqual(r[0], r[1])
+        self.assertEqual(pwm.guessranks([]).tolist(), [])
+
     def test_getallgroups(self):
         for inp, res in [([1, 2, 3],
                           set([(1,), (2,), (3,), (1, 2), (2, 3), (1, 3), (1, 2, 3)]))]:
             res1 = set(helper.getallgroups(inp))
             self.assertEqual(res1, res, "Expecting: {}, got: {}".format(res, res1))
+
+    def test_open_get_chunks(self):
+        pws = list(helper.open_get_line(phpbb_leak_file, limit=5000))
+        chunks = list(helper.open_get_chunks(phpbb_leak_file, chunk_bytes=4096,
+                                             limit=5000))
+        self.assertGreater(len(chunks), 1)
+        # limit=0, as limit=-1, means no limit
+        self.assertEqual(len(list(helper.open_get_line(test_file, sep='\t',
+                                                       limit=0))), 3)
+        self.assertEqual(pws, [(w, c) for counts, ws in chunks
+                               for w, c in zip(ws, counts.tolist())])
+        for counts, ws in helper.open_get_chunks(
+                test_file, sep='\t', min_len=7, charset=set('password ')):
+            self.assertEqual(list(ws), ['password', ' password'])
+            self.assertEqual(counts.tolist(), [1234, 35])
+
+    def test_get_chunks_malformed(self):
+        f = io.BytesIO(b"  12 abc\nxyz\n 0 zero\n3 \n 4  two  words\r\n5 a\x00b")
+        self.assertEqual(
+            [(w, c) for counts, ws in helper.get_chunks(f)
+             for w, c in zip(ws, counts.tolist())],
+            [('abc', 12), ('two  words', 4), ('a\\x00b', 5)]
+        )
+
+    def test_prefetch_multistream_bz2(self):
+        import bz2
+        import gzip
+        with gzip.open(phpbb_leak_file) as f:
+            raw = f.read(1 << 20)
+        with tempfile.TemporaryDirectory() as d:
+            fname = os.path.join(d, 'multi.txt.bz2')
+            with open(fname, 'wb') as f:
+                for i in range(0, len(raw), 100000):
+                    f.write(bz2.compress(raw[i:i + 100000]))
+            for workers in [1, 3]:
+                with helper.PrefetchReader(fname, block_size=4096, depth=2,
+                                           workers=workers) as r:
+                    self.assertEqual(r.read(10), raw[:10])
+                    self.assertEqual(r.read(), raw[10:])
+            with helper.PrefetchReader(fname, block_size=4096, depth=1) as r:
+                r.read(1)  # closing early must not hang
+            # streams longer than max_segment are decompressed in blocks
+            with open(fname, 'rb') as f:
+                blocks = list(helper._bz2_decompress_parallel(
+                    f, 3, 4096, max_segment=20000))
+            self.assertEqual(b''.join(blocks), raw)
+            self.assertEqual(max(map(len, blocks)), 4096)
+            # a single stream file is read in blocks, not in one piece
+            fname = os.path.join(d, 'single.txt.bz2')
+            with open(fname, 'wb') as f:
+                f.write(bz2.compress(raw))
+            blocks = list(helper._iter_blocks(fname, 4096, 4))
+            self.assertEqual(b''.join(blocks), raw)
+            self.assertEqual(max(map(len, blocks)), 4096)
+
+    def test_codecs(self):
+        import dawg
+        import zipfile
+        T = dawg.IntCompletionDAWG([('abc', 1), ('abd', 2), ('b', 3)])
+        with tempfile.TemporaryDirectory() as d:
+            for codec in helper.available_codecs():
+                if codec == 'zip':
+                    continue
+                fname = os.path.join(d, 'm.dawg.' + codec)
+                helper.save_dawg(T, fname)
+                self.assertEqual(helper.file_type(fname), codec)
+                T1 = helper.load_dawg(os.path.join(d, 'm.dawg'),
+                                      dawg.IntCompletionDAWG)
+                self.assertEqual(T1.items(), T.items())
+                os.remove(fname)
+            fname = os.path.join(d, 'pws.zip')
+            with zipfile.ZipFile(fname, 'w') as z:
+                z.write(test_file, 'testf.txt')
+            self.assertEqual(
+                list(helper.open_get_line(fname, sep='\t')),
+                list(helper.open_get_line(test_file, sep='\t'))
+            )